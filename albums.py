@@ -11,13 +11,21 @@ import os
 import sys
 import string
 import math
-from datetime import datetime
+import time
+import atexit
 import logging
 import argparse
+import itertools
 import plistlib                 # To read iTunes export xml file
 from tinytag import TinyTag     # ID3 Tag reader
 import yaml
 import playlist
+import extsort
+import stats
+import dates
+import daemon
+import query
+import metrics
 
 
 def parse_commandline():
@@ -45,15 +53,21 @@ def parse_commandline():
     parser.add_argument('action',
                         help="""
     The action you wish to perform.  index creates an xml file froom the
-    source, whereas compare compares exactly two sources.  playlist generates
-    playlists from the music.
+    source, whereas compare compares exactly two sources.  diff compares two
+    snapshots of the same source track by track.  merge combines
+    several sources into a single index with each track appearing once.
+    playlist generates playlists from the music.  stats reports statistics
+    on the quality of the music.  query lists the albums or tracks matching a
+    filter expression.  serve keeps indices in memory and answers compare,
+    lookup, query and playlist requests from other invocations.
     """,
-                        choices=['index', 'compare', 'playlist']
+                        choices=['index', 'compare', 'diff', 'merge',
+                                 'playlist', 'query', 'serve', 'stats']
                         )
     parser.add_argument('files',
                         help='The file(s) to work on - compare needs exactly '
                              + '2 files',
-                        nargs='+'
+                        nargs='*'
                         )
     parser.add_argument('-l',
                         '--loglevel',
@@ -82,7 +96,63 @@ def parse_commandline():
                         help='Should the media paths be relative to the '
                              + 'playlist'
                         )
+    parser.add_argument('-m',
+                        '--memory-limit',
+                        dest='memory_limit',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Compare, diff, and sort songs for playlists, '
+                             + 'using sorted runs on disk holding at most '
+                             + 'this many MB in memory'
+                        )
+    parser.add_argument('-q',
+                        '--query',
+                        dest='query',
+                        default=None,
+                        required=False,
+                        help='The filter expression for query, e.g. '
+                             + '\'genre == "Rock" and bitrate < 192\''
+                        )
+    parser.add_argument('-o',
+                        '--output',
+                        dest='output',
+                        default='query.txt',
+                        required=False,
+                        help='The file to save query results to.  An .m3u '
+                             + 'file is saved as a playlist, otherwise as '
+                             + 'a list of albums'
+                        )
+    parser.add_argument('-s',
+                        '--server',
+                        dest='server',
+                        default=None,
+                        required=False,
+                        help='The Unix socket of the index server to serve '
+                             + 'on, or to send compare and playlist requests '
+                             + 'to.  Defaults to ' + daemon.DEFAULT_SOCKET
+                             + ', which compare and playlist use whenever a '
+                             + 'server is running there'
+                        )
+    parser.add_argument('--metrics-file',
+                        dest='metrics_file',
+                        default=None,
+                        required=False,
+                        help='Write metrics in the Prometheus text format to '
+                             + 'this file when finished, e.g. for the node '
+                             + 'exporter textfile collector'
+                        )
+    parser.add_argument('--metrics-port',
+                        dest='metrics_port',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='Serve metrics on this localhost port while '
+                             + 'running'
+                        )
     args = parser.parse_args()
+    if len(args.files) == 0:
+        parser.error('the following arguments are required: files')
     if args.loglevel.upper() == 'CRITICAL':
         log.setLevel(logging.CRITICAL)
     elif args.loglevel.upper() == 'ERROR  ':
@@ -122,9 +192,15 @@ def artist_album_from_xml(filename):
 
     """
     log = logging.getLogger(__name__)
+    started = time.perf_counter()
     path = os.path.abspath(filename)
     log.info('Opening ' + path)
     data = plistlib.readPlist(path)
+    metrics.counter('albums_bytes_read_total',
+                    'Bytes of indices and iTunes exports read').inc(
+        os.path.getsize(path), source='xml')
+    problems = metrics.counter('albums_tag_problems_total',
+                               'Tracks with missing tags')
 
     tracks = data['Tracks']
     music = {}
@@ -139,6 +215,7 @@ def artist_album_from_xml(filename):
             artist = track['Artist']
         else:
             artist = None
+            problems.inc(source='xml', tag='artist')
             log.warning("Unable to find Artist for track_id: " + track_id)
 
         if artist is not None:
@@ -146,6 +223,7 @@ def artist_album_from_xml(filename):
                 album = track['Album']
             else:
                 album = ''
+                problems.inc(source='xml', tag='album')
                 log.warning('Unable to get album for track_id: ' + track_id)
 
         if 'Album' in track:
@@ -220,9 +298,19 @@ def artist_album_from_xml(filename):
             log.debug('Processed: ' + artist + '/' + album + '/'
                       + track_tags['title'])
 
+    _indexed(len(tracks), time.perf_counter() - started, 'xml')
     return music
 
 
+def _indexed(files, seconds, source):
+    """Record the number and rate of tracks indexed from a source."""
+    metrics.counter('albums_files_total', 'Tracks indexed').inc(
+        files, source=source)
+    metrics.gauge('albums_files_per_second',
+                  'Tracks indexed per second by the last run').set(
+        files / seconds if seconds > 0 else 0, source=source)
+
+
 def artist_album_from_dirs(basedir):
     """
     Recursively index music metadata from directory tree.
@@ -247,6 +335,14 @@ def artist_album_from_dirs(basedir):
     """
     log = logging.getLogger(__name__)
     music_file_exts = ['.mp3', '.flac', '.ogg', '.wav', '.wma', '.mp4', '.m4a']
+    tag_seconds = metrics.histogram('albums_tag_seconds',
+                                    'Time to read the tags of a music file')
+    bytes_read = metrics.counter('albums_music_bytes_total',
+                                 'Bytes of music files indexed')
+    problems = metrics.counter('albums_tag_problems_total',
+                               'Tracks with missing tags')
+    started = time.perf_counter()
+    files = 0
     music = {}
     artist = None
     album = ''
@@ -256,10 +352,16 @@ def artist_album_from_dirs(basedir):
             path = os.path.abspath(dirName + '/' + fname)
             name, ext = os.path.splitext(path)
             if ext in music_file_exts:
+                tag_started = time.perf_counter()
                 tag = TinyTag.get(path)
+                tag_seconds.observe(time.perf_counter() - tag_started,
+                                    ext=ext)
+                bytes_read.inc(tag.filesize or 0)
+                files += 1
 
                 if tag.albumartist is None or tag.albumartist == '':
                     if tag.artist is None or tag.artist == '':
+                        problems.inc(source='dirs', tag='artist')
                         log.warning('Unable to find artist for file: ' + path)
                         artist = None
                     else:
@@ -268,6 +370,7 @@ def artist_album_from_dirs(basedir):
                     artist = tag.albumartist
 
                 if tag.album is None or tag.album == '':
+                    problems.inc(source='dirs', tag='album')
                     log.warning('Unable to get album for file: ' + path)
                     album = ''
                 else:
@@ -301,6 +404,7 @@ def artist_album_from_dirs(basedir):
                     log.debug('Processed: ' + artist + '/' + album
                               + '/' + track_name)
 
+    _indexed(files, time.perf_counter() - started, 'dirs')
     return music
 
 
@@ -326,6 +430,9 @@ def index(location, save_yml=True, save_to=None):
             basefilename of the source
     """
     log = logging.getLogger(__name__)
+    index_seconds = metrics.histogram('albums_index_seconds',
+                                      'Time to load or save an index',
+                                      buckets=metrics.JOB_BUCKETS)
     music = {}
     if location is not None:
         path = os.path.abspath(location)
@@ -337,8 +444,15 @@ def index(location, save_yml=True, save_to=None):
             elif ext == '.yml':
                 save_yml = False
                 log.info('Loading pre-indexed data from yml: ' + path)
+                started = time.perf_counter()
                 with open(path, 'r') as f:
                     music = yaml.load(f)
+                index_seconds.observe(time.perf_counter() - started,
+                                      operation='load')
+                metrics.counter('albums_bytes_read_total',
+                                'Bytes of indices and iTunes exports '
+                                + 'read').inc(os.path.getsize(path),
+                                              source='yml')
             else:
                 log.error('Unrecognised file type: ' + path)
 
@@ -356,11 +470,178 @@ def index(location, save_yml=True, save_to=None):
                 out = save_to
             else:
                 out = name + '.yml'
+            started = time.perf_counter()
             with open(out, 'w') as f:
                 f.write(yaml.dump(music))
+            index_seconds.observe(time.perf_counter() - started,
+                                  operation='save')
     return music, name
 
 
+def index_name(location):
+    """
+    Get the base name index() gives to the index of a location.
+
+    Args:
+        location:  A string containing the location of file or directory
+
+    Returns:
+        The base file name of the location without its extension
+    """
+    name, ext = os.path.splitext(os.path.abspath(location))
+    name = os.path.basename(name)
+    if name is None or name == '':
+        name = 'index'
+    return name
+
+
+def iter_tracks(music):
+    """
+    Iterate over every track in a hierarchical index.
+
+    Args:
+        music:  A hierarchical index of artist->album->tracks
+
+    Yields:
+        A tuple of (artist, album, track_tags) for each track in the index
+    """
+    for artist in music:
+        for album in music[artist]:
+            for track_tags in music[artist][album]:
+                yield artist, album, track_tags
+
+
+def merge_key(artist, album, track_tags):
+    """
+    Create a key identifying a track independently of its source.
+
+    The key is built from the normalised artist, album and title along with
+    the disc and track numbers, so the same track indexed from a flac
+    directory, an mp3 directory or an iTunes export produces the same key.
+    A missing disc number is taken to be disc 1, as iTunes often leaves it
+    out.  Tracks with neither a title nor a track number can't be matched, so
+    they are keyed on their location instead, or on the track itself if it
+    has no location either.
+
+    Args:
+        artist:  The artist the track is indexed under
+        album:  The album the track is indexed under
+        track_tags:  The tag dictionary for the track
+
+    Returns:
+        A hashable tuple identifying the track
+    """
+    title = normalise(track_tags.get('title') or '')
+    track = _number(track_tags.get('track'))
+    if title == '' and track == '':
+        if track_tags.get('location') is None:
+            # iTunes entries such as streams have no file location
+            return ('track', id(track_tags))
+        return ('location', track_tags['location'])
+    return (normalise(artist),
+            normalise(album),
+            _number(track_tags.get('disc'), missing='1'),
+            track,
+            title)
+
+
+def _number(value, missing=''):
+    """Normalise a disc or track number which may be an int or a string."""
+    if value is None or str(value).strip() == '':
+        return missing
+    value = str(value).split('/')[0].strip()
+    try:
+        return str(int(value))
+    except ValueError:
+        return normalise(value)
+
+
+def track_quality(track_tags):
+    """
+    Rank a copy of a track so the best copy can be chosen.
+
+    Lossless copies are preferred over lossy ones, then higher bitrates over
+    lower ones.  A copy is lossless if its file type is always lossless, or
+    if its bitrate or samplerate is beyond any lossy format, which catches
+    Apple Lossless in .m4a files.
+
+    Args:
+        track_tags:  The tag dictionary for the track
+
+    Returns:
+        A tuple which sorts higher for better quality copies
+    """
+    lossless_exts = ['.flac', '.wav', '.aif', '.aiff', '.ape', '.wv']
+    # Lossy formats top out at 320 kbps and 48 kHz
+    lossless_bitrate = 400
+    lossless_samplerate = 48000
+    bitrate = track_tags.get('bitrate') or 0
+    samplerate = track_tags.get('samplerate') or 0
+    lossless = (bitrate >= lossless_bitrate
+                or samplerate > lossless_samplerate)
+    if track_tags.get('location') is not None:
+        name, ext = os.path.splitext(track_tags['location'])
+        lossless = lossless or ext.lower() in lossless_exts
+    return lossless, bitrate
+
+
+def merge(locations, save_yml=True, save_to=None):
+    """
+    Merge several sources into a single hierarchical index.
+
+    Each location is indexed in turn using index() and its tracks are merged
+    into one artist->album->track hierarchy.  Tracks are keyed with
+    merge_key() so each track appears only once, keeping the copy ranked
+    highest by track_quality().  Artist and album names are taken from the
+    first source a track is found in.
+
+    Args:
+        locations:  A list of files or directories to be merged
+        save_yml:  Save the merged index to a yaml file?  Defaults to True
+        save_to:   The file name to save the yaml data to.  If None then
+                   defaults to 'merged.yml' in the local directory
+
+    Returns:
+        A hierarchical index of artist->album->track
+    """
+    log = logging.getLogger(__name__)
+    music = {}
+    merged = {}
+    for location in locations:
+        source, name = index(location, save_yml=False)
+        added = 0
+        replaced = 0
+        for artist, album, track_tags in iter_tracks(source):
+            key = merge_key(artist, album, track_tags)
+            if key not in merged:
+                merged[key] = track_tags
+                if artist not in music:
+                    music[artist] = {}
+                if album not in music[artist]:
+                    music[artist][album] = [track_tags]
+                else:
+                    music[artist][album].append(track_tags)
+                added += 1
+            elif track_quality(track_tags) > track_quality(merged[key]):
+                # Update in place so the track keeps its position in the
+                # hierarchy
+                log.debug('Better copy: ' + str(track_tags['location']))
+                merged[key].clear()
+                merged[key].update(track_tags)
+                replaced += 1
+        log.info('Merged ' + name + ': ' + str(added) + ' new tracks, '
+                 + str(replaced) + ' replaced')
+
+    if save_yml:
+        if save_to is not None:
+            out = save_to
+        else:
+            out = 'merged.yml'
+        with open(out, 'w') as f:
+            f.write(yaml.dump(music))
+    return music
+
+
 def tree_print(music):
     """
     Print out hierarchical index data.
@@ -468,7 +749,8 @@ def normalise_index(index):
     for artist in index:
         norm_artist = normalise(artist)
         log.debug('Norm Artist: ' + artist + '->' + norm_artist)
-        norm[norm_artist] = {}
+        if norm_artist not in norm:
+            norm[norm_artist] = {}
         for album in index[artist]:
             norm_album = normalise(album)
             log.debug('Norm Album: ' + album + '->' + norm_album)
@@ -479,7 +761,53 @@ def normalise_index(index):
     return norm
 
 
-def comp(a, b):
+def album_map(index):
+    """
+    Map the normalised artist and album names of an index to the originals.
+
+    Args:
+        index:  The index to map
+
+    Returns:
+        A dictionary of normalised artist -> normalised album -> list of
+        (artist, album) tuples from the index
+    """
+    names = {}
+    for artist in index:
+        albums = names.setdefault(normalise(artist), {})
+        for album in index[artist]:
+            albums.setdefault(normalise(album), []).append((artist, album))
+    return names
+
+
+def lookup(index, artist, album=None, names=None):
+    """
+    Look up the tracks of an artist or album, ignoring punctuation and case.
+
+    Args:
+        index:  A hierarchical index of artist->album->tracks
+        artist:  The artist to look for
+        album:  The album to look for.  If None all of the artist's albums
+                are returned
+        names:  The album_map() of the index, if already built
+
+    Returns:
+        A hierarchical index containing only the matching albums
+    """
+    if names is None:
+        names = album_map(index)
+    found = {}
+    albums = names.get(normalise(artist), {})
+    if album is not None:
+        albums = {normalise(album): albums.get(normalise(album), [])}
+    for matches in albums.values():
+        for match_artist, match_album in matches:
+            found.setdefault(match_artist, {})[match_album] = \
+                index[match_artist][match_album]
+    return found
+
+
+def comp(a, b, norm_b=None):
     """
     Compare albums in index a against those in index b.
 
@@ -491,6 +819,7 @@ def comp(a, b):
     Args:
         a:  A hierarchical index of album->artist->tracks
         b:  A hierarchical index of album->artist->tracks
+        norm_b:  The normalise_index() of b, if already built
 
     Returns:
         returns a tuple of 2 artist-album lists:
@@ -498,7 +827,8 @@ def comp(a, b):
             - a_only:  Album is only in index a
     """
     log = logging.getLogger(__name__)
-    norm_b = normalise_index(b)
+    if norm_b is None:
+        norm_b = normalise_index(b)
     both = []
     a_only = []
     for artist in a:
@@ -518,7 +848,7 @@ def comp(a, b):
     return both, a_only
 
 
-def compare(a, b):
+def compare(a, b, norm_a=None, norm_b=None):
     """
     Compare index a with index b in both directions.
 
@@ -533,6 +863,8 @@ def compare(a, b):
     Args:
         a:  A hierarchical index of album->artist->tracks
         b:  A hierarchical index of album->artist->tracks
+        norm_a:  The normalise_index() of a, if already built
+        norm_b:  The normalise_index() of b, if already built
 
     Returns:
         returns a tuple of 3 artist-album lists:
@@ -540,11 +872,429 @@ def compare(a, b):
             - a_only:  Album is only in index a
             - b_only:  Album is only in index b
     """
-    both, a_only = comp(a, b)
-    both, b_only = comp(b, a)
+    started = time.perf_counter()
+    both, a_only = comp(a, b, norm_b)
+    both, b_only = comp(b, a, norm_a)
+    metrics.histogram('albums_compare_seconds', 'Time to compare two indices',
+                      buckets=metrics.JOB_BUCKETS).observe(
+        time.perf_counter() - started)
+    compared = metrics.counter('albums_compared_albums_total',
+                               'Albums compared by result')
+    compared.inc(len(both), result='both')
+    compared.inc(len(a_only), result='a_only')
+    compared.inc(len(b_only), result='b_only')
     return both, a_only, b_only
 
 
+def iter_albums(location):
+    """
+    Iterate over the artist and album names in an index.
+
+    Pre-indexed yml files are streamed using the yaml event parser, so the
+    tracks are never loaded into memory.  Any other location is indexed using
+    index().
+
+    Args:
+        location:  A string containing the location of file or directory to be
+                   indexed.
+
+    Yields:
+        A tuple of (artist, album) in the same order as the loaded index
+    """
+    path = os.path.abspath(location)
+    name, ext = os.path.splitext(path)
+    if os.path.isfile(path) and ext == '.yml':
+        with open(path, 'r') as f:
+            yield from _iter_yml_albums(f)
+    else:
+        music, name = index(location)
+        for artist in music:
+            for album in music[artist]:
+                yield artist, album
+
+
+def _iter_yml_albums(stream):
+    """Yield the (artist, album) keys from a yml index using yaml events."""
+    resolver = yaml.resolver.Resolver()
+    # One entry per open collection: [is_mapping, expecting_key]
+    stack = []
+    artist = None
+    for event in yaml.parse(stream):
+        if isinstance(event, (yaml.MappingStartEvent,
+                              yaml.SequenceStartEvent)):
+            if stack and stack[-1][0]:
+                stack[-1][1] = True
+            stack.append([isinstance(event, yaml.MappingStartEvent), True])
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            stack.pop()
+        elif isinstance(event, (yaml.ScalarEvent, yaml.AliasEvent)):
+            if stack and stack[-1][0]:
+                if stack[-1][1] and len(stack) <= 2 \
+                   and isinstance(event, yaml.ScalarEvent):
+                    key = event.value
+                    tag = resolver.resolve(yaml.ScalarNode, key,
+                                           event.implicit)
+                    if tag != resolver.DEFAULT_SCALAR_TAG:
+                        key = yaml.safe_load(key)
+                    if len(stack) == 1:
+                        artist = key
+                    else:
+                        yield artist, key
+                stack[-1][1] = not stack[-1][1]
+
+
+def compare_external(a_location, b_location, memory_limit=64 * 1024 * 1024):
+    """
+    Compare index a with index b using sorted runs on disk.
+
+    Gives the same results as compare(), but the normalised artist/album keys
+    of each index are streamed through an extsort.ExternalSorter and matched
+    with a merge join, so peak memory is bounded by `memory_limit` rather
+    than the size of the indices.  Half of the limit is used to sort the keys
+    and the rest is shared by the three result sorters, which fill up while
+    the keys are being merged.
+
+    Args:
+        a_location:  The location of index a, ideally a pre-indexed yml file
+        b_location:  The location of index b, ideally a pre-indexed yml file
+        memory_limit:  Approximate number of bytes of keys to hold in memory
+
+    Returns:
+        returns a tuple of 3 iterators over artist-album dictionaries:
+            - both:  Album is in both indices
+            - a_only:  Album is only in index a
+            - b_only:  Album is only in index b
+        Each iterator yields albums in the same order as compare().
+    """
+    log = logging.getLogger(__name__)
+    started = time.perf_counter()
+    keys = extsort.ExternalSorter(key=lambda r: (r[0], r[1]),
+                                  memory_limit=memory_limit // 2)
+    for side, location in enumerate([a_location, b_location]):
+        log.info('Sorting album keys from ' + location)
+        for seq, (artist, album) in enumerate(iter_albums(location)):
+            keys.append((normalise(artist), normalise(album), side, seq,
+                         artist, album))
+    log.debug('Album keys sorted into ' + str(keys.runs) + ' runs')
+
+    # Results are re-sorted by their position in the source index so the
+    # output order matches compare()
+    results_limit = memory_limit // 6
+    both = extsort.ExternalSorter(memory_limit=results_limit)
+    a_only = extsort.ExternalSorter(memory_limit=results_limit)
+    b_only = extsort.ExternalSorter(memory_limit=results_limit)
+    for key, group in itertools.groupby(keys, key=lambda r: (r[0], r[1])):
+        group = list(group)
+        in_a = any(r[2] == 0 for r in group)
+        in_b = any(r[2] == 1 for r in group)
+        for r in group:
+            if r[2] == 1 and in_a:
+                log.debug('Hit: ' + r[4] + ' / ' + r[5])
+                both.append(r[3:])
+            elif r[2] == 1:
+                log.debug('Miss: ' + r[4] + ' / ' + r[5])
+                b_only.append(r[3:])
+            elif not in_b:
+                log.debug('Miss: ' + r[4] + ' / ' + r[5])
+                a_only.append(r[3:])
+
+    # The results are complete once the keys have been merged, so record the
+    # same metrics as compare()
+    metrics.histogram('albums_compare_seconds', 'Time to compare two indices',
+                      buckets=metrics.JOB_BUCKETS).observe(
+        time.perf_counter() - started)
+    compared = metrics.counter('albums_compared_albums_total',
+                               'Albums compared by result')
+    compared.inc(both.count, result='both')
+    compared.inc(a_only.count, result='a_only')
+    compared.inc(b_only.count, result='b_only')
+
+    return tuple(({'artist': artist, 'album': album}
+                  for seq, artist, album in results)
+                 for results in (both, a_only, b_only))
+
+
+def iter_index_tracks(location):
+    """
+    Iterate over every track in an index.
+
+    Pre-indexed yml files are streamed using the yaml event parser, so only
+    one track is held in memory at a time.  Any other location is indexed
+    using index().
+
+    Args:
+        location:  A string containing the location of file or directory to be
+                   indexed.
+
+    Yields:
+        A tuple of (artist, album, track_tags) in the same order as the loaded
+        index
+    """
+    path = os.path.abspath(location)
+    name, ext = os.path.splitext(path)
+    if os.path.isfile(path) and ext == '.yml':
+        with open(path, 'r') as f:
+            yield from _iter_yml_tracks(f)
+    else:
+        music, name = index(location)
+        yield from iter_tracks(music)
+
+
+def _iter_yml_tracks(stream):
+    """Yield (artist, album, track_tags) from a yml index using yaml events."""
+    loader = yaml.SafeLoader(stream)
+
+    def node():
+        # Build the next key or track on its own
+        return loader.construct_document(loader.compose_node(None, None))
+
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            artist = node()
+            loader.get_event()
+            while not loader.check_event(yaml.MappingEndEvent):
+                album = node()
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield artist, album, node()
+                loader.get_event()
+            loader.get_event()
+    finally:
+        loader.dispose()
+
+
+def _located(tracks):
+    """Yield (location, track_tags) for the tracks that have a location."""
+    log = logging.getLogger(__name__)
+    for artist, album, track_tags in tracks:
+        if track_tags.get('location') is None:
+            log.warning('No location for: ' + artist + ' / ' + album
+                        + ' / ' + str(track_tags.get('title')))
+        else:
+            yield track_tags['location'], track_tags
+
+
+def _track_content(track_tags):
+    """Create a hashable signature of a track ignoring its location."""
+    return tuple(sorted((field, str(value))
+                        for field, value in track_tags.items()
+                        if field != 'location'))
+
+
+def changed_fields(old_tags, new_tags):
+    """
+    Find the tag fields that differ between two versions of a track.
+
+    Args:
+        old_tags:  The tag dictionary for the old version of the track
+        new_tags:  The tag dictionary for the new version of the track
+
+    Returns:
+        A dictionary of field -> (old value, new value) for each field that
+        has changed
+    """
+    changes = {}
+    for field in sorted(set(old_tags) | set(new_tags)):
+        if old_tags.get(field) != new_tags.get(field):
+            changes[field] = (old_tags.get(field), new_tags.get(field))
+    return changes
+
+
+def diff(old, new):
+    """
+    Compare two snapshots of the same index at the track level.
+
+    Tracks are matched on their `location` using a merge over both snapshots
+    sorted by location.  Tracks that disappear from one location and appear at
+    another with identical tags are reported as moved rather than as removed
+    and added.
+
+    Args:
+        old:  A hierarchical index of artist->album->tracks
+        new:  A later hierarchical index of the same source
+
+    Returns:
+        A dictionary of lists:
+            - added:  Tag dictionaries of tracks only in the new index
+            - removed:  Tag dictionaries of tracks only in the old index
+            - moved:  Tuples of (old tags, new tags) for moved tracks
+            - retagged:  Tuples of (old tags, new tags, changed fields) for
+                         tracks whose tags changed, see changed_fields()
+    """
+    return _diff_sorted(
+        iter(sorted(_located(iter_tracks(old)), key=lambda r: r[0])),
+        iter(sorted(_located(iter_tracks(new)), key=lambda r: r[0])))
+
+
+def diff_external(old_location, new_location, memory_limit=64 * 1024 * 1024):
+    """
+    Compare two snapshots of the same index using sorted runs on disk.
+
+    Gives the same results as diff(), but the tracks of each snapshot are
+    streamed through an extsort.ExternalSorter, so the snapshots are never
+    loaded whole.  Each snapshot's sorter gets half of `memory_limit`.
+
+    Args:
+        old_location:  The location of the old snapshot, ideally a
+                       pre-indexed yml file
+        new_location:  The location of the new snapshot, ideally a
+                       pre-indexed yml file
+        memory_limit:  Approximate number of bytes of tracks to hold in memory
+
+    Returns:
+        A dictionary of lists as returned by diff()
+    """
+    log = logging.getLogger(__name__)
+    sorted_tracks = []
+    for location in [old_location, new_location]:
+        log.info('Sorting tracks from ' + location)
+        tracks = extsort.ExternalSorter(key=lambda r: r[0],
+                                        memory_limit=memory_limit // 2)
+        tracks.extend(_located(iter_index_tracks(location)))
+        sorted_tracks.append(iter(tracks))
+    return _diff_sorted(*sorted_tracks)
+
+
+def _diff_sorted(old_tracks, new_tracks):
+    """Diff two iterators of (location, track_tags) sorted by location."""
+    log = logging.getLogger(__name__)
+    changes = {'added': [], 'removed': [], 'moved': [], 'retagged': []}
+    o = next(old_tracks, None)
+    n = next(new_tracks, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and o[0] < n[0]):
+            changes['removed'].append(o[1])
+            o = next(old_tracks, None)
+        elif o is None or n[0] < o[0]:
+            changes['added'].append(n[1])
+            n = next(new_tracks, None)
+        else:
+            fields = changed_fields(o[1], n[1])
+            if fields:
+                log.debug('Retagged: ' + n[0] + ' ' + str(list(fields)))
+                changes['retagged'].append((o[1], n[1], fields))
+            o = next(old_tracks, None)
+            n = next(new_tracks, None)
+
+    # Pair up removed and added tracks with the same content as moves
+    removed = {}
+    for track_tags in changes['removed']:
+        removed.setdefault(_track_content(track_tags), []).append(track_tags)
+    added = []
+    for track_tags in changes['added']:
+        candidates = removed.get(_track_content(track_tags))
+        if candidates:
+            old_tags = candidates.pop(0)
+            log.debug('Moved: ' + old_tags['location'] + ' -> '
+                      + track_tags['location'])
+            changes['moved'].append((old_tags, track_tags))
+        else:
+            added.append(track_tags)
+    changes['added'] = added
+    changes['removed'] = [track_tags
+                          for candidates in removed.values()
+                          for track_tags in candidates]
+    changes['removed'].sort(key=lambda t: t['location'])
+
+    log.info('Diff: ' + ', '.join(str(len(changes[c])) + ' ' + c
+                                  for c in changes))
+    return changes
+
+
+def diff_save(changes, filename):
+    """
+    Save the changes between two snapshots.
+
+    Saves the changes found by diff() to a file, one track per line, with
+    each line prefixed by the type of change:
+        + added
+        - removed
+        > moved
+        ~ retagged
+
+    Args:
+        changes:  A dictionary of changes as returned by diff()
+        filename:  The filename of the file to save the data to.
+    """
+    with open(filename, 'w') as f:
+        for track_tags in changes['added']:
+            f.write('+ ' + track_tags['location'] + '\n')
+        for track_tags in changes['removed']:
+            f.write('- ' + track_tags['location'] + '\n')
+        for old_tags, new_tags in changes['moved']:
+            f.write('> ' + old_tags['location'] + ' -> '
+                    + new_tags['location'] + '\n')
+        for old_tags, new_tags, fields in changes['retagged']:
+            f.write('~ ' + new_tags['location'] + ' :: '
+                    + '; '.join(field + ': ' + str(old) + ' -> ' + str(new)
+                                for field, (old, new) in fields.items())
+                    + '\n')
+
+
+######################
+# Statistics
+######################
+
+def library_stats(music):
+    """
+    Flatten an index into columns for calculating statistics.
+
+    Args:
+        music:  A hierarchical index of artist->album->tracks
+
+    Returns:
+        A stats.Library holding one row per track
+    """
+    def tracks():
+        for artist in music:
+            for album in music[artist]:
+                songs = music[artist][album]
+                years = dates.resolver.resolve_album(songs)
+                for track_tags, year in zip(songs, years):
+                    yield (artist, album, track_tags, year,
+                           track_quality(track_tags)[0])
+
+    return stats.Library(tracks())
+
+
+######################
+# Queries
+######################
+
+def query_save(results, filename, relative=True):
+    """
+    Save the tracks found by a query.
+
+    Saves the albums containing the tracks, one album per line, unless the
+    filename has an '.m3u' extension when the tracks are saved as a playlist.
+
+    Args:
+        results:  A list of (artist, album, track_tags) tuples as returned by
+                  query.QueryIndex.query()
+        filename:  The filename of the file to save the data to.
+        relative:  Use relative paths in the playlist?
+    """
+    log = logging.getLogger(__name__)
+    name, ext = os.path.splitext(filename)
+    if ext != '.m3u':
+        aa_save(query.albums(results), filename)
+        return
+
+    pl = playlist.Playlist(filename=os.path.abspath(filename))
+    for artist, album, track_tags in results:
+        try:
+            pl.append(track_tags)
+        except ValueError:
+            log.error("Missing playlist data for: " + str(track_tags))
+    log.info("Saving query playlist: " + str(pl))
+    pl.write(relative=relative)
+
+
 ######################
 # Playlists
 ######################
@@ -553,8 +1303,8 @@ def get_year(datestring):
     """
     Parse a date type string looking for a year.
 
-    Parse a date type string into a datetime object using ever less accurate
-    date formats.
+    Parse a date type string using ever less accurate date formats.  Years are
+    resolved by dates.resolver, which remembers each distinct date string.
 
     Args:
         datestring:  The string to parse for a date
@@ -563,48 +1313,11 @@ def get_year(datestring):
         A numeric year value as an integer
 
     """
-    log = logging.getLogger(__name__)
-    if datestring is None:
-        return None
-    log.debug("Attempting to parse date from: " + datestring)
-    # Try to parse ISO date string
-    try:
-        dt = datetime.strptime(datestring, '%Y-%m-%dT%H:%M:%SZ')
-        log.debug("Got high quality date: " + str(dt.year))
-    except ValueError:
-        # Try to parse general date format
-        try:
-            dt = datetime.strptime(datestring, '%Y-%m-%d')
-            log.debug("Got valid date: " + str(dt.year))
-        except ValueError:
-            # Try to parse year/month format
-            try:
-                dt = datetime.strptime(datestring, '%Y-%m')
-                log.debug("Parsed year and month: " + str(dt.year))
-            except ValueError:
-                # Try to parse just a 4-digit year
-                try:
-                    dt = datetime.strptime(datestring, '%Y')
-                    log.debug("Parsed 4-digit year only: " + str(dt.year))
-                except ValueError:
-                    # Try to parse a 2-digit year
-                    try:
-                        dt = datetime.strptime(datestring, '%y')
-                        log.warning("Only able to parse 2 digit year: "
-                                    + str(dt.year) + " from: " + datestring)
-                    except ValueError:
-                        # Failed...
-                        dt = None
-                        log.error("Unable to parse year value from: "
-                                  + datestring)
-
-    if dt is not None:
-        return dt.year
-    else:
-        return None
+    return dates.resolver.year(datestring)
 
 
-def write_playlists(music, playlist_dir='.', relative=True):
+def write_playlists(music, playlist_dir='.', relative=True,
+                    memory_limit=64 * 1024 * 1024):
     """
     Write playlists based on the music metadata.
 
@@ -614,14 +1327,27 @@ def write_playlists(music, playlist_dir='.', relative=True):
         Year - All songs released in a year
         Decade - All songs released in a decade
 
+    Year and decade playlists are written from a sort of the dated songs,
+    which is spilled to disk beyond `memory_limit`, so the songs are never all
+    held in memory at once.
+
     Args:
         playlist_dir:  The directory below which to create the playlists
         relative:  Use relative paths in the playlists?
+        memory_limit:  Approximate number of bytes of dated songs to sort in
+                       memory
 
     """
     log = logging.getLogger(__name__)
-    # Create a dictionary to hold the songs for each year
-    years = {}
+    started = time.perf_counter()
+    written = metrics.counter('albums_playlists_written_total',
+                              'Playlists written by kind')
+    skipped = metrics.counter('albums_playlist_songs_skipped_total',
+                              'Songs left out of playlists for missing data')
+    # Sort the songs by year, keeping the order they were found within a year
+    years = extsort.ExternalSorter(key=lambda r: (r[0], r[1]),
+                                   memory_limit=memory_limit)
+    dated = 0
     # Sort out the directories
     basedir = os.path.abspath(playlist_dir)
     basedir = os.path.join(basedir, 'playlists')
@@ -659,67 +1385,220 @@ def write_playlists(music, playlist_dir='.', relative=True):
             pl_filename = os.path.join(artist_dir, pl_filename)
             album_pl = playlist.Playlist(filename=pl_filename)
 
+            # Resolve the release years for the whole album at once
+            songs = music[artist][album]
+            album_years = dates.resolver.resolve_album(songs)
+
             # Loop over the songs on the album
-            for song in music[artist][album]:
+            for song, yr in zip(songs, album_years):
                 log.debug("Song: " + song['title'])
                 # Add song to the playlists
                 try:
                     artist_pl.append(song)
                     album_pl.append(song)
-                    # Place the song in the correct year list
-                    yr = get_year(song['release_date'])
+                    # Keep just what the year playlists need
                     if yr is not None:
-                        if yr not in years:
-                            log.debug("First song from year: " + str(yr))
-                            years[yr] = [song]
-                        else:
-                            years[yr].append(song)
+                        years.append((yr, dated, {
+                            'title': song['title'],
+                            'location': song['location'],
+                            'duration': song['duration']}))
+                        dated += 1
 
                 except ValueError:
+                    skipped.inc()
                     log.error("Missing playlist data for: " + str(song))
 
             # Write the album playlist
             log.info("Saving album playlist: " + str(album_pl))
             album_pl.write(relative=relative)
+            written.inc(kind='album')
         # Write the artist playlist
         log.info("Saving artist playlist: " + str(artist_pl))
         artist_pl.write(relative=relative)
+        written.inc(kind='artist')
+
+    log.info("Release years resolved: " + str(dates.resolver))
+    _year_cache_metrics()
 
-    # Create the year and decade playlists
+    # Create the year and decade playlists in a single pass over the sort
     log.debug("Starting to process time-based playlists")
     decade = None
     dc_pl = None
-    for yr in sorted(years):
-        log.debug("Processing year: " + str(yr))
-        # Decade playlist
-        if decade != str(math.floor(yr/10)*10):
-            # We have changed decades so write the old playlist
-            if decade is not None:
-                # Not the first year processed so write decade playlist
-                log.info("Saving decade playlist: " + str(dc_pl))
-                dc_pl.write(relative=relative)
-            # Set the decade and create the playlist
-            decade = str(math.floor(yr/10)*10)
-            log.debug("New Decade: " + decade)
-            pl_filename = os.path.join(releaseddir, decade + '_s.m3u')
-            dc_pl = playlist.Playlist(filename=pl_filename)
-
+    year = None
+    yr_pl = None
+    for yr, seq, song in years:
         # Year playlist
-        pl_filename = os.path.join(releaseddir, str(yr) + '.m3u')
-        yr_pl = playlist.Playlist(filename=pl_filename)
+        if yr != year:
+            # We have changed years so finish the old playlist
+            if yr_pl is not None:
+                log.info("Saved year playlist: " + str(yr_pl))
+                yr_pl.close()
+                written.inc(kind='year')
+            year = yr
+            log.debug("Processing year: " + str(yr))
+            # Decade playlist
+            if decade != str(math.floor(yr/10)*10):
+                # We have changed decades so finish the old playlist
+                if dc_pl is not None:
+                    log.info("Saved decade playlist: " + str(dc_pl))
+                    dc_pl.close()
+                    written.inc(kind='decade')
+                # Set the decade and create the playlist
+                decade = str(math.floor(yr/10)*10)
+                log.debug("New Decade: " + decade)
+                pl_filename = os.path.join(releaseddir, decade + '_s.m3u')
+                dc_pl = playlist.PlaylistWriter(pl_filename, relative)
+            pl_filename = os.path.join(releaseddir, str(yr) + '.m3u')
+            yr_pl = playlist.PlaylistWriter(pl_filename, relative)
+
+        # Add the song to the playlists
+        yr_pl.append(song)
+        dc_pl.append(song)
+
+    # Finish the last year and decade playlists
+    if yr_pl is not None:
+        log.info("Saved year playlist: " + str(yr_pl))
+        yr_pl.close()
+        written.inc(kind='year')
+        log.info("Saved decade playlist: " + str(dc_pl))
+        dc_pl.close()
+        written.inc(kind='decade')
+
+    metrics.histogram('albums_playlists_seconds',
+                      'Time to write all of the playlists',
+                      buckets=metrics.JOB_BUCKETS).observe(
+        time.perf_counter() - started)
+
+
+def _year_cache_metrics():
+    """Record the hits and misses of the release year cache."""
+    info = dates.resolver.cache_info()
+    cache = metrics.counter('albums_year_cache_lookups_total',
+                            'Release year lookups by result')
+    # Bring the counter up to date with the cache's running totals
+    cache.inc(max(0, info.hits - cache.value(result='hit')), result='hit')
+    cache.inc(max(0, info.misses - cache.value(result='miss')),
+              result='miss')
+
+
+######################
+# Index server
+######################
+
+def _serve_compare(cache, params):
+    """Compare two cached indices for the index server."""
+    a, norm_a = cache.derived(params['a'], 'normalised', normalise_index)
+    b, norm_b = cache.derived(params['b'], 'normalised', normalise_index)
+    both, a_only, b_only = compare(a, b, norm_a=norm_a, norm_b=norm_b)
+    return {'both': both, 'a_only': a_only, 'b_only': b_only}
+
+
+def _serve_lookup(cache, params):
+    """Look up an artist or album in a cached index for the index server."""
+    music, names = cache.derived(params['index'], 'names', album_map)
+    return lookup(music, params['artist'], params.get('album'), names=names)
+
+
+def _serve_query(cache, params):
+    """Query a cached index for the index server."""
+    music, tracks = cache.derived(params['index'], 'query', query.QueryIndex)
+    found = tracks.query(params['query'])
+    return [track_tags for artist, album, track_tags in found]
+
+
+def _serve_playlist(cache, params):
+    """Write playlists from a cached index for the index server."""
+    write_playlists(cache.get(params['index']),
+                    params.get('playlist_dir', '.'),
+                    params.get('relative', True))
+    return str(cache)
+
+
+def serve(locations, address=None):
+    """
+    Keep indices in memory and answer requests for them until interrupted.
 
-        # Loop over the songs adding to the playlists
-        for song in years[yr]:
-            yr_pl.append(song)
-            dc_pl.append(song)
+    The indices at `locations` are loaded up front and requests for any other
+    index are refused.  Indices are reloaded when their files change on disk.
+    The server answers the actions:
+        compare:  {'a': location, 'b': location} -> both, a_only and b_only
+        lookup:  {'index': location, 'artist': name, 'album': name}
+        query:  {'index': location, 'query': expression} -> track tags
+        playlist:  {'index': location, 'playlist_dir': dir, 'relative': bool}
 
-        # Write the "year" playlist
-        log.info("Saving year playlist: " + str(yr_pl))
-        yr_pl.write(relative=relative)
+    Args:
+        locations:  A list of index locations to load before serving
+        address:  The path of the Unix socket to listen on
+    """
+    cache = daemon.IndexCache(lambda path: index(path, save_yml=False)[0],
+                              locations)
+    for location in locations:
+        cache.derived(location, 'normalised', normalise_index)
+    daemon.serve(cache,
+                 {'compare': _serve_compare,
+                  'lookup': _serve_lookup,
+                  'query': _serve_query,
+                  'playlist': _serve_playlist},
+                 address)
+
+
+def _server_running(args):
+    """
+    Check whether an index server is running.
+
+    The server given by --server is used, otherwise the default server is
+    used if one is running.
+    """
+    log = logging.getLogger(__name__)
+    if daemon.running(args.server):
+        return True
+    if args.server is not None:
+        log.warning('No index server at ' + args.server + ', working here')
+    return False
+
+
+def _remote_compare(args):
+    """Compare using the index server, if it is running."""
+    log = logging.getLogger(__name__)
+    if not _server_running(args):
+        return False
+    try:
+        result = daemon.request('compare',
+                                {'a': os.path.abspath(args.files[0]),
+                                 'b': os.path.abspath(args.files[1])},
+                                args.server)
+    except (ConnectionError, daemon.DaemonError) as e:
+        log.warning('Index server failed to compare: ' + str(e)
+                    + ', comparing here')
+        return False
+    aa_save(result['both'], 'both.txt')
+    aa_save(result['a_only'], index_name(args.files[0]) + '_only.txt')
+    aa_save(result['b_only'], index_name(args.files[1]) + '_only.txt')
+    return True
+
+
+def _remote_playlist(args):
+    """Write playlists using the index server, if it is running."""
+    log = logging.getLogger(__name__)
+    if not _server_running(args):
+        return False
+    try:
+        daemon.request('playlist',
+                       {'index': os.path.abspath(args.files[0]),
+                        'playlist_dir': os.path.abspath(args.playlist_dir),
+                        'relative': args.relative},
+                       args.server)
+    except (ConnectionError, daemon.DaemonError) as e:
+        log.warning('Index server failed to write playlists: ' + str(e)
+                    + ', writing playlists here')
+        return False
+    return True
 
-    # Write the last Decade playlist
-    log.info("Saving decade playlist: " + str(dc_pl))
-    dc_pl.write(relative=relative)
+
+def _write_metrics(filename):
+    """Write the metrics file on exit."""
+    _year_cache_metrics()
+    metrics.registry.write(filename)
 
 
 def main():
@@ -728,6 +1607,10 @@ def main():
     log = logging.getLogger(__name__)
     args, parser = parse_commandline()
     log.debug("Starting with: " + str(args))
+    if args.metrics_port is not None:
+        metrics.registry.serve(args.metrics_port)
+    if args.metrics_file is not None:
+        atexit.register(_write_metrics, args.metrics_file)
 
     if args.action == 'index':
         for f in args.files:
@@ -736,6 +1619,19 @@ def main():
         if len(args.files) != 2:
             parser.print_help()
             sys.exit(-1)
+        elif _remote_compare(args):
+            log.info('Compared using the index server')
+        elif args.memory_limit is not None:
+            a_name = index_name(args.files[0])
+            b_name = index_name(args.files[1])
+            both, a_only, b_only = compare_external(
+                args.files[0],
+                args.files[1],
+                memory_limit=args.memory_limit * 1024 * 1024)
+
+            aa_save(both, 'both.txt')
+            aa_save(a_only, a_name + '_only.txt')
+            aa_save(b_only, b_name + '_only.txt')
         else:
             a, a_name = index(args.files[0])
             b, b_name = index(args.files[1])
@@ -744,13 +1640,61 @@ def main():
             aa_save(both, 'both.txt')
             aa_save(a_only, a_name + '_only.txt')
             aa_save(b_only, b_name + '_only.txt')
+    elif args.action == 'diff':
+        if len(args.files) != 2:
+            parser.print_help()
+            sys.exit(-1)
+        else:
+            if args.memory_limit is not None:
+                changes = diff_external(
+                    args.files[0],
+                    args.files[1],
+                    memory_limit=args.memory_limit * 1024 * 1024)
+            else:
+                old, old_name = index(args.files[0])
+                new, new_name = index(args.files[1])
+                changes = diff(old, new)
+            diff_save(changes, index_name(args.files[0]) + '_'
+                      + index_name(args.files[1]) + '_diff.txt')
+    elif args.action == 'merge':
+        merge(args.files)
     elif args.action == 'playlist':
         if len(args.files) != 1:
             parser.print_help()
             sys.exit(-1)
+        elif _remote_playlist(args):
+            log.info('Playlists written by the index server')
         else:
             music, name = index(args.files[0])
-            write_playlists(music, args.playlist_dir, args.relative)
+            if args.memory_limit is not None:
+                write_playlists(music, args.playlist_dir, args.relative,
+                                memory_limit=args.memory_limit * 1024 * 1024)
+            else:
+                write_playlists(music, args.playlist_dir, args.relative)
+    elif args.action == 'query':
+        if len(args.files) != 1 or args.query is None:
+            parser.print_help()
+            sys.exit(-1)
+        else:
+            music, name = index(args.files[0])
+            try:
+                results = query.QueryIndex(music).query(args.query)
+            except ValueError as e:
+                parser.error(str(e))
+            log.info('Query matched ' + str(len(results)) + ' tracks')
+            query_save(results, args.output, args.relative)
+    elif args.action == 'serve':
+        try:
+            serve(args.files, args.server)
+        except daemon.DaemonError as e:
+            log.error(str(e))
+            sys.exit(-1)
+    elif args.action == 'stats':
+        for f in args.files:
+            music, name = index(f)
+            library = library_stats(music)
+            log.info('Calculating statistics for ' + str(library))
+            stats.report_save(library.report(), name + '_stats.txt')
 
 
 if __name__ == "__main__":
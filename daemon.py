@@ -0,0 +1,295 @@
+"""Provide a resident index server and a thin client for it."""
+
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler
+import metrics
+
+
+# The server listens on a Unix socket that only its owner can use, so other
+# users and web pages open in a browser can't send it requests
+DEFAULT_SOCKET = os.path.expanduser('~/.albums.sock')
+
+
+class DaemonError(Exception):
+    """The server could not carry out a request."""
+
+
+def _mtime(path):
+    """Get the latest modification time of a file or directory tree."""
+    latest = os.path.getmtime(path)
+    for dirpath, dirnames, filenames in os.walk(path):
+        # Renames and deletions change the mtime of the directory holding
+        # them, and edits the mtime of the file itself
+        for name in dirnames + filenames:
+            try:
+                latest = max(latest,
+                             os.path.getmtime(os.path.join(dirpath, name)))
+            except OSError:
+                # Removed since the directory was listed
+                pass
+    return latest
+
+
+class IndexCache:
+    """
+    Class encapsulating a set of indices held in memory.
+
+    Indices are loaded on first use and reloaded when the modification time
+    of their file, or of anything in their directory tree, changes.  Data
+    derived from an index, such as its normalised key maps, can be cached
+    alongside it and is discarded when the index is reloaded.
+    """
+
+    def __init__(self, loader, locations):
+        """
+        Initialise the class and methods.
+
+        Args:
+            loader:  A function taking an absolute location and returning the
+                     index loaded from it
+            locations:  The locations of the indices that may be loaded.
+                        Requests for any other location are refused.
+        """
+        self._loader = loader
+        self._locations = set(os.path.abspath(location)
+                              for location in locations)
+        self._indices = {}
+        # The cache lock only guards the dictionaries.  Each index has its own
+        # lock, held while it loads or builds derived data, so a slow index
+        # doesn't hold up requests for the others.
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self.hits = 0
+        self.loads = 0
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return ("IndexCache(" + str(len(self._indices)) + " indices, "
+                + str(self.hits) + " hits, " + str(self.loads) + " loads)")
+
+    def _path_lock(self, path):
+        """Get the lock for an index."""
+        if path not in self._locations:
+            raise DaemonError('Not serving: ' + path)
+        with self._lock:
+            if path not in self._path_locks:
+                self._path_locks[path] = threading.Lock()
+            return self._path_locks[path]
+
+    def _entry(self, path):
+        """
+        Get the cache entry for an index, loading it if needed.
+
+        The caller must hold the lock for the index.
+        """
+        log = logging.getLogger(__name__)
+        mtime = _mtime(path)
+        requests = metrics.counter('albums_index_cache_total',
+                                   'Index server lookups by result')
+        entry = self._indices.get(path)
+        if entry is not None and entry['mtime'] == mtime:
+            with self._lock:
+                self.hits += 1
+            requests.inc(result='hit')
+            return entry
+        if entry is None:
+            log.info('Loading index: ' + path)
+        else:
+            log.info('Reloading changed index: ' + path)
+        entry = {'mtime': mtime,
+                 'music': self._loader(path),
+                 'derived': {}}
+        with self._lock:
+            self._indices[path] = entry
+            self.loads += 1
+        requests.inc(result='load')
+        return entry
+
+    def get(self, location):
+        """
+        Get an index, loading or reloading it if needed.
+
+        Args:
+            location:  The location of the index
+
+        Returns:
+            The loaded index
+        """
+        path = os.path.abspath(location)
+        with self._path_lock(path):
+            return self._entry(path)['music']
+
+    def derived(self, location, name, build):
+        """
+        Get data derived from an index, building it if needed.
+
+        Args:
+            location:  The location of the index
+            name:  A name for the derived data
+            build:  A function taking the index and returning the derived data
+
+        Returns:
+            A tuple of the index and its derived data, both taken from the
+            same version of the index
+        """
+        path = os.path.abspath(location)
+        with self._path_lock(path):
+            entry = self._entry(path)
+            if name not in entry['derived']:
+                entry['derived'][name] = build(entry['music'])
+            return entry['music'], entry['derived'][name]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer JSON requests of the form POST /<action>."""
+
+    def do_POST(self):
+        """Dispatch a request to the registered action handler."""
+        log = logging.getLogger(__name__)
+        action = self.path.strip('/')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+            if action == 'ping':
+                result = str(self.server.cache)
+            elif action in self.server.handlers:
+                result = self.server.handlers[action](self.server.cache,
+                                                      params)
+            else:
+                raise DaemonError('Unknown action: ' + action)
+            status = 200
+            body = {'result': result}
+        except DaemonError as e:
+            log.warning('Refused request: ' + action + ': ' + str(e))
+            status = 400
+            body = {'error': type(e).__name__ + ': ' + str(e)}
+        except Exception as e:
+            log.exception('Request failed: ' + action)
+            status = 500
+            body = {'error': type(e).__name__ + ': ' + str(e)}
+
+        data = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Send the request log to the logging module."""
+        logging.getLogger(__name__).debug(format % args)
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    """Answer HTTP requests on a Unix socket, one thread per request."""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        """Create the socket readable and writable by its owner only."""
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+
+def serve(cache, handlers, address=None):
+    """
+    Answer requests against the cached indices until interrupted.
+
+    Args:
+        cache:  The IndexCache holding the indices
+        handlers:  A dictionary of action -> function(cache, params), where
+                   params is the dictionary sent by the client and the
+                   function returns a JSON serialisable result
+        address:  The path of the Unix socket to listen on.  Defaults to
+                  DEFAULT_SOCKET
+
+    Throws:
+        DaemonError if a server is already listening on the socket
+    """
+    log = logging.getLogger(__name__)
+    if address is None:
+        address = DEFAULT_SOCKET
+    if os.path.exists(address):
+        if running(address):
+            raise DaemonError('A server is already running on ' + address)
+        # Left behind by a server that didn't shut down cleanly
+        os.remove(address)
+    server = _Server(address, _Handler)
+    server.cache = cache
+    server.handlers = handlers
+    log.info('Serving ' + ', '.join(sorted(handlers)) + ' on ' + address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Shutting down')
+    finally:
+        server.server_close()
+        os.remove(address)
+
+
+class _Connection(http.client.HTTPConnection):
+    """An HTTP connection over a Unix socket."""
+
+    def __init__(self, address, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self._address = address
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._address)
+
+
+def request(action, params, address=None, timeout=None):
+    """
+    Send a request to a running server.
+
+    Args:
+        action:  The action to perform
+        params:  A JSON serialisable dictionary of parameters for the action
+        address:  The path of the server's Unix socket.  Defaults to
+                  DEFAULT_SOCKET
+        timeout:  Seconds to wait for a response, or None to wait forever
+
+    Returns:
+        The result returned by the action handler
+
+    Throws:
+        ConnectionError if no server is running
+        DaemonError if the server could not carry out the request
+    """
+    if address is None:
+        address = DEFAULT_SOCKET
+    connection = _Connection(address, timeout=timeout)
+    try:
+        connection.request('POST', '/' + action,
+                           body=json.dumps(params).encode('utf-8'),
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        body = json.loads(response.read())
+    except OSError as e:
+        raise ConnectionError(address + ': ' + str(e))
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise DaemonError(body.get('error'))
+    return body['result']
+
+
+def running(address=None):
+    """Check whether a server is answering at `address`."""
+    try:
+        request('ping', {}, address, timeout=1)
+    except (ConnectionError, OSError):
+        return False
+    return True
@@ -0,0 +1,156 @@
+"""Provide fast resolution of release years from tag date strings."""
+
+import re
+import functools
+import logging
+from datetime import datetime
+
+
+# A single pattern recognising each of the date formats accepted by
+# datetime.strptime with the formats, in order of preference:
+#     %Y-%m-%dT%H:%M:%SZ, %Y-%m-%d, %Y-%m, %Y, %y
+# The groups use the same regular expressions as strptime so the same
+# strings are accepted.
+DATE_PATTERN = re.compile(r"""
+    (?P<Y>\d\d\d\d)
+    (?:-(?P<m>1[0-2]|0[1-9]|[1-9])
+        (?:-(?P<d>3[01]|[12]\d|0[1-9]|[1-9]|\ [1-9])
+            (?:T(?P<H>2[0-3]|[0-1]\d|\d)
+               :(?P<M>[0-5]\d|\d)
+               :(?P<S>6[0-1]|[0-5]\d|\d)Z)?
+        )?
+    )?
+    |(?P<y>\d\d)
+    """, re.VERBOSE | re.IGNORECASE)
+
+
+def parse_year(datestring):
+    """
+    Parse a date type string looking for a year.
+
+    Args:
+        datestring:  The string to parse for a date
+
+    Returns:
+        A numeric year value as an integer, or None if no year could be found
+    """
+    log = logging.getLogger(__name__)
+    found = DATE_PATTERN.fullmatch(datestring)
+    if found is None:
+        log.error("Unable to parse year value from: " + datestring)
+        return None
+
+    if found.group('y') is not None:
+        # Two digit years follow the POSIX convention used by strptime
+        year = int(found.group('y'))
+        year += 2000 if year <= 68 else 1900
+        log.warning("Only able to parse 2 digit year: " + str(year)
+                    + " from: " + datestring)
+        return year
+
+    # Check the date exists, as strptime would
+    try:
+        dt = datetime(int(found.group('Y')),
+                      int(found.group('m') or 1),
+                      int(found.group('d') or 1),
+                      int(found.group('H') or 0),
+                      int(found.group('M') or 0),
+                      int(found.group('S') or 0))
+    except ValueError:
+        log.error("Unable to parse year value from: " + datestring)
+        return None
+    log.debug("Parsed year: " + str(dt.year) + " from: " + datestring)
+    return dt.year
+
+
+class YearResolver:
+    """
+    Class encapsulating a memoised year parser.
+
+    Years are parsed with parse_year() and remembered in a bounded least
+    recently used cache, so each distinct date string in a library is only
+    parsed once.
+    """
+
+    def __init__(self, maxsize=4096):
+        """
+        Initialise the class and methods.
+
+        Args:
+            maxsize:  The maximum number of distinct date strings to remember
+        """
+        self._parse = functools.lru_cache(maxsize=maxsize)(parse_year)
+
+    def __str__(self):
+        """Provide a string version of self."""
+        info = self._parse.cache_info()
+        return ("YearResolver(" + str(info.currsize) + " dates, "
+                + str(round(self.hit_rate() * 100, 1)) + "% hits)")
+
+    def year(self, datestring):
+        """
+        Get the year from a date type string.
+
+        Args:
+            datestring:  The string to parse for a date.  datetime objects,
+                         as found in iTunes exports, are also accepted.
+
+        Returns:
+            A numeric year value as an integer, or None
+        """
+        if datestring is None:
+            return None
+        if isinstance(datestring, datetime):
+            return datestring.year
+        return self._parse(str(datestring))
+
+    def years(self, datestrings):
+        """
+        Get the years from a batch of date type strings.
+
+        Each distinct date string in the batch is only resolved once.
+
+        Args:
+            datestrings:  An iterable of date type strings
+
+        Returns:
+            A list of years in the same order as `datestrings`
+        """
+        resolved = {}
+        years = []
+        for datestring in datestrings:
+            if datestring not in resolved:
+                resolved[datestring] = self.year(datestring)
+            years.append(resolved[datestring])
+        return years
+
+    def resolve_album(self, songs):
+        """
+        Get the release year of every song on an album.
+
+        Args:
+            songs:  A list of tag dictionaries containing 'release_date'
+
+        Returns:
+            A list of years in the same order as `songs`
+        """
+        return self.years(song.get('release_date') for song in songs)
+
+    def cache_info(self):
+        """Get the hits, misses, maxsize and currsize of the cache."""
+        return self._parse.cache_info()
+
+    def hit_rate(self):
+        """Get the fraction of lookups answered from the cache."""
+        info = self._parse.cache_info()
+        lookups = info.hits + info.misses
+        if lookups == 0:
+            return 0.0
+        return info.hits / lookups
+
+    def cache_clear(self):
+        """Forget all remembered date strings."""
+        self._parse.cache_clear()
+
+
+resolver = YearResolver()
@@ -0,0 +1,153 @@
+"""Provide sorting of record streams that are too large to hold in memory."""
+
+import sys
+import heapq
+import logging
+import pickle
+import tempfile
+
+
+def sizeof(record):
+    """
+    Estimate the memory used by a record and the objects it contains.
+
+    Strings, numbers and other simple objects are measured with
+    sys.getsizeof().  Tuples, lists, sets and dictionaries are measured
+    together with their contents.  Objects shared between records are
+    counted each time, so the estimate errs on the high side.
+
+    Args:
+        record:  The record to measure
+
+    Returns:
+        The estimated size in bytes
+    """
+    size = sys.getsizeof(record)
+    if isinstance(record, dict):
+        for key, value in record.items():
+            size += sizeof(key) + sizeof(value)
+    elif isinstance(record, (tuple, list, set, frozenset)):
+        for item in record:
+            size += sizeof(item)
+    return size
+
+
+class ExternalSorter:
+    """
+    Class encapsulating an external merge sort.
+
+    Records are added one at a time.  Once the estimated in-memory size of
+    the buffered records, see sizeof(), exceeds the memory limit they are
+    sorted and spilled to a temporary file as a sorted run.  Iterating over
+    the sorter merges the runs back together, so only one record per run is
+    held in memory at a time.
+    """
+
+    def __init__(self, key=None, memory_limit=64 * 1024 * 1024):
+        """
+        Initialise the class and methods.
+
+        Args:
+            key:  A function extracting the sort key from a record, as for
+                  sorted().  Defaults to sorting the records themselves.
+            memory_limit:  Approximate number of bytes of memory the
+                           buffered records may use before a sorted run is
+                           spilled to disk
+        """
+        self._key = key
+        self._memory_limit = memory_limit
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+        # The number of records added
+        self.count = 0
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return ("ExternalSorter(" + str(len(self._runs)) + " runs, "
+                + str(len(self._buffer)) + " buffered)")
+
+    @property
+    def runs(self):
+        """Get the number of sorted runs spilled to disk."""
+        return len(self._runs)
+
+    def append(self, record):
+        """
+        Add a record to be sorted.
+
+        Args:
+            record:  Any picklable object
+
+        Returns:
+            self
+        """
+        self._buffer.append(record)
+        self.count += 1
+        # Allow for the buffer's pointer to the record as well as the record
+        self._buffered += sizeof(record) + 8
+        if self._buffered >= self._memory_limit:
+            self._spill()
+        return self
+
+    def extend(self, records):
+        """Add each record from an iterable to be sorted."""
+        for record in records:
+            self.append(record)
+        return self
+
+    def _spill(self):
+        """Sort the buffered records and write them to disk as a run."""
+        log = logging.getLogger(__name__)
+        self._buffer.sort(key=self._key)
+        run = tempfile.TemporaryFile()
+        for record in self._buffer:
+            pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self._runs.append(run)
+        log.debug("Spilled run " + str(len(self._runs)) + " of "
+                  + str(len(self._buffer)) + " records")
+        self._buffer = []
+        self._buffered = 0
+
+    @staticmethod
+    def _read_run(run):
+        """Read back the records from a sorted run."""
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                break
+
+    def __iter__(self):
+        """
+        Iterate over all of the records in sorted order.
+
+        The sorter is emptied by the iteration and any temporary files are
+        closed once it completes.
+        """
+        if not self._runs:
+            records = sorted(self._buffer, key=self._key)
+            self._buffer = []
+            self._buffered = 0
+            yield from records
+            return
+
+        if self._buffer:
+            self._spill()
+        runs = self._runs
+        self._runs = []
+        try:
+            yield from heapq.merge(*[self._read_run(run) for run in runs],
+                                   key=self._key)
+        finally:
+            for run in runs:
+                run.close()
+
+    def close(self):
+        """Discard any records and temporary files."""
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._buffer = []
+        self._buffered = 0
@@ -0,0 +1,275 @@
+"""
+Provide metrics in the Prometheus text format.
+
+Metrics are created on first use and fetched by name afterwards, in the same
+way as loggers, e.g.
+
+    files = metrics.counter('albums_files_total', 'Music files indexed')
+    files.inc(source='dirs')
+
+The metrics can be written to a file for the node exporter textfile
+collector with write(), or served over HTTP while a job runs with serve().
+"""
+
+import os
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30, 60, 300]
+JOB_BUCKETS = [1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200]
+
+
+def _labels(labels):
+    """Format a dictionary of labels for the text format."""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') + '"'
+        for name, value in labels) + '}'
+
+
+def _number(value):
+    """Format a sample value for the text format."""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Class encapsulating the samples of a metric, one per set of labels."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        """
+        Initialise the class and methods.
+
+        Args:
+            name:  The metric name
+            help:  A description of the metric
+        """
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return type(self).__name__ + "(" + self.name + ")"
+
+    def value(self, **labels):
+        """Get the current value for a set of labels."""
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        """Yield (name, labels, value) for each sample of the metric."""
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+    def expose(self):
+        """Format the metric in the Prometheus text format."""
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' ' + self.kind]
+        for name, labels, value in self.samples():
+            lines.append(name + _labels(labels) + ' ' + _number(value))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """Class encapsulating a count which only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the count for a set of labels by `amount`."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Class encapsulating a value which can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the value for a set of labels."""
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    """Class encapsulating counts of observations in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=None):
+        """
+        Initialise the class and methods.
+
+        Args:
+            name:  The metric name
+            help:  A description of the metric
+            buckets:  The upper bounds of the buckets.  Defaults to
+                      DEFAULT_BUCKETS, which suit durations in seconds.
+        """
+        super().__init__(name, help)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        """Record an observation for a set of labels."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {'buckets': [0] * len(self.buckets),
+                                     'sum': 0, 'count': 0}
+            sample = self._values[key]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                sample['buckets'][position] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def value(self, **labels):
+        """Get the number of observations for a set of labels."""
+        sample = self._values.get(tuple(sorted(labels.items())))
+        if sample is None:
+            return 0
+        return sample['count']
+
+    def samples(self):
+        """Yield (name, labels, value) for the buckets, sum and count."""
+        with self._lock:
+            values = [(labels, dict(sample, buckets=list(sample['buckets'])))
+                      for labels, sample in self._values.items()]
+        for labels, sample in values:
+            total = 0
+            for bound, count in zip(self.buckets, sample['buckets']):
+                total += count
+                yield (self.name + '_bucket',
+                       labels + (('le', _number(bound)),), total)
+            yield (self.name + '_bucket', labels + (('le', '+Inf'),),
+                   sample['count'])
+            yield self.name + '_sum', labels, sample['sum']
+            yield self.name + '_count', labels, sample['count']
+
+
+class Registry:
+    """Class encapsulating a named set of metrics."""
+
+    def __init__(self):
+        """Initialise the class and methods."""
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return "Registry(" + str(len(self._metrics)) + " metrics)"
+
+    def _get(self, cls, name, help, **kwargs):
+        """Get a metric by name, creating it if needed."""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(name + ' is already a ' + metric.kind)
+            return metric
+
+    def counter(self, name, help):
+        """Get a Counter by name, creating it if needed."""
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        """Get a Gauge by name, creating it if needed."""
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=None):
+        """Get a Histogram by name, creating it if needed."""
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def expose(self):
+        """Format all of the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        return ''.join(metric.expose() for metric in metrics)
+
+    def write(self, filename):
+        """
+        Write all of the metrics to a file.
+
+        The file is written under a temporary name and then renamed, so the
+        textfile collector never reads a partly written file.
+
+        Args:
+            filename:  The file to write, which should have a '.prom'
+                       extension for the textfile collector
+        """
+        log = logging.getLogger(__name__)
+        temp = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(self.expose())
+        os.replace(temp, filename)
+        log.debug('Wrote metrics to ' + filename)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve the metrics over HTTP from a background thread.
+
+        Args:
+            port:  The port to listen on
+            host:  The address to listen on.  Defaults to localhost only.
+
+        Returns:
+            The server, which can be stopped with its shutdown() method
+        """
+        log = logging.getLogger(__name__)
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = registry.expose().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        log.info('Serving metrics on http://%s:%d/metrics'
+                 % server.server_address)
+        return server
+
+
+registry = Registry()
+
+
+def counter(name, help):
+    """Get a Counter from the default registry, creating it if needed."""
+    return registry.counter(name, help)
+
+
+def gauge(name, help):
+    """Get a Gauge from the default registry, creating it if needed."""
+    return registry.gauge(name, help)
+
+
+def histogram(name, help, buckets=None):
+    """Get a Histogram from the default registry, creating it if needed."""
+    return registry.histogram(name, help, buckets)
@@ -4,6 +4,39 @@ import os.path
 import logging
 
 
+def _valid(tag_data):
+    """Check a song has the data needed for a playlist entry."""
+    return 'title' in tag_data \
+        and 'location' in tag_data \
+        and 'duration' in tag_data
+
+
+def _entry(song, basedir, relative=True, record_markers=True):
+    """
+    Format a song as an m3u playlist entry.
+
+    Args:
+        song: A dictionary-like object containing title, location, duration
+        basedir: The directory containing the playlist
+        relative: Should we use relative paths?
+        record_markers: Should we use the #EXT... markers?
+
+    Returns:
+        The lines of the entry as a string
+    """
+    entry = ''
+    if record_markers:
+        entry += ('#EXTINF:'
+                  + str(int(song['duration'])) +
+                  "," + song['title'] + '\n'
+                  )
+    if relative:
+        entry += os.path.relpath(song['location'], start=basedir)
+    else:
+        entry += song['location']
+    return entry + '\n'
+
+
 class Playlist:
     """Class encapsulating an m3u playlist."""
 
@@ -37,9 +70,7 @@ class Playlist:
         Returns:
             self
         """
-        if 'title' in tag_data \
-           and 'location' in tag_data \
-           and 'duration' in tag_data:
+        if _valid(tag_data):
             self._songs.append(tag_data)
         else:
             raise ValueError
@@ -57,9 +88,7 @@ class Playlist:
             self
         """
         log = logging.getLogger(__name__)
-        if 'title' in tag_data \
-           and 'location' in tag_data \
-           and 'duration' in tag_data:
+        if _valid(tag_data):
             self._songs.insert(position, tag_data)
         else:
             log.warning("Song not added to playlist: " + str(tag_data))
@@ -83,21 +112,82 @@ class Playlist:
         if self._filename is None:
             raise IOError
 
+        basedir = os.path.dirname(self._filename)
         with open(self._filename, 'w') as f:
             if record_markers:
                 f.write('#EXTM3U\n')
             for song in self._songs:
-                if record_markers:
-                    record_marker = ('#EXTINF:'
-                                     + str(int(song['duration'])) +
-                                     "," + song['title'] + '\n'
-                                     )
-                    f.write(record_marker)
-
-                if relative:
-                    basedir = os.path.dirname(self._filename)
-                    location = os.path.relpath(song['location'], start=basedir)
-                else:
-                    location = song['location']
-                location += '\n'
-                f.write(location)
+                f.write(_entry(song, basedir, relative, record_markers))
+
+
+class PlaylistWriter:
+    """
+    Class encapsulating an m3u playlist written as songs are added.
+
+    Unlike Playlist the songs are not held in memory.  Each song is written
+    to the file as soon as it is appended, so the writer should be closed,
+    or used as a context manager, once all of the songs have been added.
+    """
+
+    def __init__(self, filename, relative=True, record_markers=True):
+        """
+        Initialise the class and open the playlist file.
+
+        Args:
+            filename: The file to write the playlist to
+            relative: Should we use relative paths?
+            record_markers: Should we use the #EXT... markers?
+
+        Throws:
+            IOError if problems opening the file
+        """
+        self._filename = filename
+        self._basedir = os.path.dirname(filename)
+        self._relative = relative
+        self._record_markers = record_markers
+        self._count = 0
+        self._file = open(filename, 'w')
+        if record_markers:
+            self._file.write('#EXTM3U\n')
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return "PlaylistWriter(" + self._filename + ")"
+
+    def __len__(self):
+        """Get the number of songs written."""
+        return self._count
+
+    def __enter__(self):
+        """Use the writer as a context manager."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close the playlist file when leaving the context."""
+        self.close()
+
+    @property
+    def filename(self):
+        """Get the filename of the playlist."""
+        return self._filename
+
+    def append(self, tag_data):
+        """
+        Write a song to the playlist.
+
+        Args:
+            tag_data: Same restrictions as for Playlist.append
+
+        Returns:
+            self
+        """
+        if not _valid(tag_data):
+            raise ValueError
+        self._file.write(_entry(tag_data, self._basedir, self._relative,
+                                self._record_markers))
+        self._count += 1
+        return self
+
+    def close(self):
+        """Finish writing the playlist."""
+        self._file.close()
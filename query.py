@@ -0,0 +1,367 @@
+"""
+Query the tracks of an index with filter expressions.
+
+Expressions compare track fields with values or other fields, and can be
+combined with `and`, `or`, `not` and brackets, e.g.
+
+    genre == "rock" and decade == 1970
+    disc < disc_total
+    bitrate < 192 or not (samplerate == 44100)
+
+Fields are the keys of the track tags, plus `year` and `decade` which are
+derived from `release_date`.  The NUMERIC_FIELDS are compared as numbers and
+all other fields as strings ignoring case.  Comparisons with a missing value
+are always false.
+"""
+
+import re
+import bisect
+import logging
+import dates
+
+
+HASH_FIELDS = ['artist', 'album', 'genre']
+SORTED_FIELDS = ['year', 'bitrate', 'duration']
+NUMERIC_FIELDS = ['year', 'decade', 'bitrate', 'duration', 'samplerate',
+                  'filesize', 'disc', 'disc_total', 'track', 'track_total']
+OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+FLIPPED = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<number>-?\d+(?:\.\d*)?)
+        |"(?P<dstring>[^"]*)"
+        |'(?P<sstring>[^']*)'
+        |(?P<op>==|!=|<=|>=|<|>)
+        |(?P<bracket>[()])
+        |(?P<word>\w+)
+    )""", re.VERBOSE)
+
+
+def tokenise(expression):
+    """
+    Split a filter expression into tokens.
+
+    Args:
+        expression:  The filter expression
+
+    Returns:
+        A list of (kind, value) tuples, where kind is one of 'value', 'op',
+        'bracket', 'keyword' or 'field'
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        found = TOKEN.match(expression, position)
+        if found is None:
+            raise ValueError('Unexpected text in query: '
+                             + expression[position:].strip())
+        position = found.end()
+        if found.group('number') is not None:
+            tokens.append(('value', found.group('number')))
+        elif found.group('dstring') is not None:
+            tokens.append(('value', found.group('dstring')))
+        elif found.group('sstring') is not None:
+            tokens.append(('value', found.group('sstring')))
+        elif found.group('op') is not None:
+            tokens.append(('op', found.group('op')))
+        elif found.group('bracket') is not None:
+            tokens.append(('bracket', found.group('bracket')))
+        elif found.group('word').lower() in ['and', 'or', 'not']:
+            tokens.append(('keyword', found.group('word').lower()))
+        else:
+            tokens.append(('field', found.group('word')))
+    return tokens
+
+
+def parse(expression):
+    """
+    Parse a filter expression into a tree.
+
+    The tree is made of tuples:
+        ('or', left, right)
+        ('and', left, right)
+        ('not', operand)
+        ('cmp', op, left, right)  where left and right are ('field', name)
+                                  or ('value', value)
+
+    Args:
+        expression:  The filter expression
+
+    Returns:
+        The root of the tree
+
+    Throws:
+        ValueError if the expression is not valid
+    """
+    tokens = tokenise(expression)
+    position = 0
+
+    def peek():
+        if position < len(tokens):
+            return tokens[position]
+        return (None, None)
+
+    def take(kind, value=None):
+        nonlocal position
+        token = peek()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise ValueError('Expected ' + (value or kind) + ' but got '
+                             + str(token[1]) + ' in query: ' + expression)
+        position += 1
+        return token
+
+    def expr():
+        node = term()
+        while peek() == ('keyword', 'or'):
+            take('keyword')
+            node = ('or', node, term())
+        return node
+
+    def term():
+        node = factor()
+        while peek() == ('keyword', 'and'):
+            take('keyword')
+            node = ('and', node, factor())
+        return node
+
+    def factor():
+        if peek() == ('keyword', 'not'):
+            take('keyword')
+            return ('not', factor())
+        if peek() == ('bracket', '('):
+            take('bracket', '(')
+            node = expr()
+            take('bracket', ')')
+            return node
+        left = operand()
+        op = take('op')[1]
+        return ('cmp', op, left, operand())
+
+    def operand():
+        if peek()[0] in ['field', 'value']:
+            return take(peek()[0])
+        raise ValueError('Expected a field or value but got '
+                         + str(peek()[1]) + ' in query: ' + expression)
+
+    tree = expr()
+    if position != len(tokens):
+        raise ValueError('Unexpected ' + str(peek()[1]) + ' in query: '
+                         + expression)
+    return tree
+
+
+def _key(value, numeric=False):
+    """
+    Make a value comparable.
+
+    Args:
+        value:  The value of a field or a value from a query
+        numeric:  Compare the value as a number?
+
+    Returns:
+        A float for numeric comparisons, or a lower case string otherwise.
+        None if the value is missing or is not a valid number.
+    """
+    if value is None:
+        return None
+    if not numeric:
+        return str(value).lower()
+    try:
+        # Numbers such as track 3/12 count as their first part
+        number = float(str(value).split('/')[0])
+    except ValueError:
+        return None
+    if number != number:
+        # NaN never compares equal, so treat it as missing
+        return None
+    return number
+
+
+def _numeric(*operands):
+    """Check whether a comparison involves a numeric field."""
+    return any(kind == 'field' and name in NUMERIC_FIELDS
+               for kind, name in operands)
+
+
+class QueryIndex:
+    """
+    Class encapsulating the tracks of an index and its secondary indexes.
+
+    Hash indexes are built on the HASH_FIELDS and sorted arrays on the
+    SORTED_FIELDS when the class is created, so repeated queries only
+    examine the tracks the indexes cannot rule out.
+    """
+
+    def __init__(self, music):
+        """
+        Initialise the class and methods.
+
+        Args:
+            music:  A hierarchical index of artist->album->tracks
+        """
+        log = logging.getLogger(__name__)
+        self._tracks = []
+        self._years = []
+        for artist in music:
+            for album in music[artist]:
+                songs = music[artist][album]
+                years = dates.resolver.resolve_album(songs)
+                for track_tags, year in zip(songs, years):
+                    self._tracks.append((artist, album, track_tags))
+                    self._years.append(year)
+
+        self._hashes = {}
+        for field in HASH_FIELDS:
+            self._hashes[field] = {}
+            for row in range(len(self._tracks)):
+                key = _key(self._value(row, field), field in NUMERIC_FIELDS)
+                self._hashes[field].setdefault(key, []).append(row)
+
+        self._sorted = {}
+        for field in SORTED_FIELDS:
+            rows = [(_key(self._value(row, field), numeric=True), row)
+                    for row in range(len(self._tracks))]
+            rows = sorted(r for r in rows if r[0] is not None)
+            self._sorted[field] = ([r[0] for r in rows], [r[1] for r in rows])
+        log.debug('Built query indexes for ' + str(len(self)) + ' tracks')
+
+    def __len__(self):
+        """Get the number of tracks that can be queried."""
+        return len(self._tracks)
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return "QueryIndex(" + str(len(self)) + " tracks)"
+
+    def _value(self, row, field):
+        """Get the value of a field for a track."""
+        artist, album, track_tags = self._tracks[row]
+        if field == 'year':
+            return self._years[row]
+        if field == 'decade':
+            if self._years[row] is None:
+                return None
+            return self._years[row] // 10 * 10
+        if field in track_tags:
+            return track_tags[field]
+        if field == 'artist':
+            return artist
+        if field == 'album':
+            return album
+        return None
+
+    def _candidates(self, node):
+        """
+        Find the rows that might match part of a query using the indexes.
+
+        Returns:
+            A set of rows that includes every match, or None if the indexes
+            cannot narrow the search
+        """
+        if node[0] == 'and':
+            left = self._candidates(node[1])
+            right = self._candidates(node[2])
+            if left is None:
+                return right
+            if right is None:
+                return left
+            return left & right
+        if node[0] == 'or':
+            left = self._candidates(node[1])
+            right = self._candidates(node[2])
+            if left is None or right is None:
+                return None
+            return left | right
+        if node[0] != 'cmp':
+            return None
+
+        op, left, right = node[1:]
+        if left[0] == 'value' and right[0] == 'field':
+            op, left, right = FLIPPED[op], right, left
+        if left[0] != 'field' or right[0] != 'value':
+            return None
+        field = left[1]
+        value = _key(right[1], _numeric(left))
+        if value is None:
+            # Comparisons with a missing value never match
+            return set()
+        if field in self._hashes and op == '==':
+            return set(self._hashes[field].get(value, []))
+        if field in self._sorted and op != '!=':
+            values, rows = self._sorted[field]
+            low, high = 0, len(values)
+            if op in ['==', '>=']:
+                low = bisect.bisect_left(values, value)
+            elif op == '>':
+                low = bisect.bisect_right(values, value)
+            if op in ['==', '<=']:
+                high = bisect.bisect_right(values, value)
+            elif op == '<':
+                high = bisect.bisect_left(values, value)
+            return set(rows[low:high])
+        return None
+
+    def _match(self, node, row):
+        """Evaluate a query tree against a track."""
+        if node[0] == 'and':
+            return self._match(node[1], row) and self._match(node[2], row)
+        if node[0] == 'or':
+            return self._match(node[1], row) or self._match(node[2], row)
+        if node[0] == 'not':
+            return not self._match(node[1], row)
+        op, left, right = node[1:]
+        numeric = _numeric(left, right)
+        a = _key(self._value(row, left[1]) if left[0] == 'field' else left[1],
+                 numeric)
+        b = _key(self._value(row, right[1]) if right[0] == 'field'
+                 else right[1], numeric)
+        if a is None or b is None:
+            return False
+        return OPERATORS[op](a, b)
+
+    def query(self, expression):
+        """
+        Find the tracks matching a filter expression.
+
+        Args:
+            expression:  The filter expression, see parse()
+
+        Returns:
+            A list of (artist, album, track_tags) tuples in index order
+        """
+        log = logging.getLogger(__name__)
+        tree = parse(expression)
+        rows = self._candidates(tree)
+        if rows is None:
+            rows = range(len(self._tracks))
+        else:
+            rows = sorted(rows)
+        log.debug('Query ' + expression + ' examining ' + str(len(rows))
+                  + ' of ' + str(len(self)) + ' tracks')
+        return [self._tracks[row] for row in rows if self._match(tree, row)]
+
+
+def albums(results):
+    """
+    List the albums containing the tracks found by a query.
+
+    Args:
+        results:  A list of (artist, album, track_tags) tuples
+
+    Returns:
+        A list of dictionaries containing 'artist' and 'album' keys, in the
+        order they were first found
+    """
+    found = {}
+    for artist, album, track_tags in results:
+        found[(artist, album)] = {'artist': artist, 'album': album}
+    return list(found.values())
@@ -0,0 +1,231 @@
+"""Provide library statistics and quality reports over an index."""
+
+import json
+import logging
+import numpy as np
+
+
+BITRATE_BINS = [0, 96, 128, 160, 192, 256, 320]
+BITRATE_TOLERANCE = 64
+
+
+def _number(value):
+    """Convert a tag value to a float, using NaN where it is missing."""
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class Library:
+    """
+    Class encapsulating a columnar view of an index.
+
+    Each track becomes one row.  Numeric tags are held in NumPy arrays, with
+    NaN marking missing values, and artist, album and genre are held as
+    integer codes into label lists so they can be grouped without Python
+    loops.
+    """
+
+    def __init__(self, tracks):
+        """
+        Initialise the class and methods.
+
+        Args:
+            tracks:  An iterable of (artist, album, track_tags, year, lossless)
+                     tuples, one per track
+        """
+        log = logging.getLogger(__name__)
+        self.artists = []
+        self.albums = []
+        self.genres = []
+        artist_codes = {}
+        album_codes = {}
+        genre_codes = {}
+        columns = {'artist': [], 'album': [], 'genre': [], 'bitrate': [],
+                   'samplerate': [], 'duration': [], 'filesize': [],
+                   'track_total': [], 'year': [], 'lossless': []}
+        for artist, album, track_tags, year, lossless in tracks:
+            if artist not in artist_codes:
+                artist_codes[artist] = len(self.artists)
+                self.artists.append(artist)
+            if (artist, album) not in album_codes:
+                album_codes[(artist, album)] = len(self.albums)
+                self.albums.append((artist, album))
+            # Genres are grouped ignoring case, as they are by queries, and
+            # labelled with the spelling first found
+            genre = str(track_tags.get('genre') or '')
+            if genre.lower() not in genre_codes:
+                genre_codes[genre.lower()] = len(self.genres)
+                self.genres.append(genre)
+            columns['artist'].append(artist_codes[artist])
+            columns['album'].append(album_codes[(artist, album)])
+            columns['genre'].append(genre_codes[genre.lower()])
+            for field in ['bitrate', 'samplerate', 'duration', 'filesize',
+                          'track_total']:
+                columns[field].append(_number(track_tags.get(field)))
+            columns['year'].append(_number(year))
+            columns['lossless'].append(lossless)
+
+        self.artist = np.array(columns['artist'], dtype=np.int64)
+        self.album = np.array(columns['album'], dtype=np.int64)
+        self.genre = np.array(columns['genre'], dtype=np.int64)
+        self.bitrate = np.array(columns['bitrate'], dtype=np.float64)
+        self.samplerate = np.array(columns['samplerate'], dtype=np.float64)
+        self.duration = np.array(columns['duration'], dtype=np.float64)
+        self.filesize = np.array(columns['filesize'], dtype=np.float64)
+        self.track_total = np.array(columns['track_total'], dtype=np.float64)
+        self.year = np.array(columns['year'], dtype=np.float64)
+        self.lossless = np.array(columns['lossless'], dtype=bool)
+        log.debug("Flattened " + str(len(self)) + " tracks")
+
+    def __len__(self):
+        """Get the number of tracks in the library."""
+        return len(self.artist)
+
+    def __str__(self):
+        """Provide a string version of self."""
+        return ("Library(" + str(len(self)) + " tracks, "
+                + str(len(self.albums)) + " albums)")
+
+    def bitrate_distribution(self):
+        """Count the tracks falling into each bitrate band in kbps."""
+        known = self.bitrate[~np.isnan(self.bitrate)]
+        bands = np.digitize(known, BITRATE_BINS[1:], right=True)
+        counts = np.bincount(bands, minlength=len(BITRATE_BINS))
+        labels = ['<=' + str(b) for b in BITRATE_BINS[1:]]
+        labels.append('>' + str(BITRATE_BINS[-1]))
+        distribution = dict(zip(labels, counts.tolist()))
+        distribution['unknown'] = int(len(self) - len(known))
+        return distribution
+
+    def samplerate_distribution(self):
+        """Count the tracks at each samplerate."""
+        known = self.samplerate[~np.isnan(self.samplerate)]
+        rates, counts = np.unique(known, return_counts=True)
+        distribution = {str(int(r)): int(c) for r, c in zip(rates, counts)}
+        distribution['unknown'] = int(len(self) - len(known))
+        return distribution
+
+    def lossless_share(self):
+        """Find the tracks and the fraction that are lossless by artist."""
+        tracks = np.bincount(self.artist, minlength=len(self.artists))
+        lossless = np.bincount(self.artist, weights=self.lossless,
+                               minlength=len(self.artists))
+        share = lossless / np.maximum(tracks, 1)
+        return {artist: {'tracks': int(t), 'lossless': round(float(s), 3)}
+                for artist, t, s in zip(self.artists, tracks, share)}
+
+    def inconsistent_albums(self):
+        """
+        Find albums with inconsistent quality.
+
+        An album is inconsistent if it mixes lossless and lossy tracks, or if
+        the bitrates of its lossy tracks differ by more than
+        BITRATE_TOLERANCE kbps.
+        """
+        n = len(self.albums)
+        tracks = np.bincount(self.album, minlength=n)
+        lossless = np.bincount(self.album, weights=self.lossless, minlength=n)
+        lossy_bitrate = np.where(self.lossless, np.nan, self.bitrate)
+        low = np.full(n, np.nan)
+        high = np.full(n, np.nan)
+        np.fmin.at(low, self.album, lossy_bitrate)
+        np.fmax.at(high, self.album, lossy_bitrate)
+        with np.errstate(invalid='ignore'):
+            spread = np.nan_to_num(high - low) > BITRATE_TOLERANCE
+        mixed = (lossless > 0) & (lossless < tracks)
+        return [{'artist': self.albums[i][0], 'album': self.albums[i][1]}
+                for i in np.flatnonzero(mixed | spread)]
+
+    def missing_track_total(self):
+        """Find albums with at least one track missing `track_total`."""
+        missing = np.bincount(self.album, weights=np.isnan(self.track_total),
+                              minlength=len(self.albums))
+        return [{'artist': self.albums[i][0], 'album': self.albums[i][1]}
+                for i in np.flatnonzero(missing)]
+
+    def by_decade(self):
+        """Total the tracks, duration and filesize by decade of release."""
+        dated = ~np.isnan(self.year)
+        decades, codes = np.unique(np.floor(self.year[dated] / 10) * 10,
+                                   return_inverse=True)
+        tracks = np.bincount(codes, minlength=len(decades))
+        duration = np.bincount(codes, weights=np.nan_to_num(
+            self.duration[dated]), minlength=len(decades))
+        filesize = np.bincount(codes, weights=np.nan_to_num(
+            self.filesize[dated]), minlength=len(decades))
+        return {str(int(d)) + 's': {'tracks': int(t),
+                                    'duration': round(float(s), 1),
+                                    'filesize': int(f)}
+                for d, t, s, f in zip(decades, tracks, duration, filesize)}
+
+    def by_genre(self):
+        """Count the tracks in each genre."""
+        tracks = np.bincount(self.genre, minlength=len(self.genres))
+        return {genre or 'unknown': int(t)
+                for genre, t in zip(self.genres, tracks)}
+
+    def report(self):
+        """
+        Create a report of all of the library statistics.
+
+        Returns:
+            A dictionary suitable for saving as JSON
+        """
+        return {
+            'tracks': len(self),
+            'artists': len(self.artists),
+            'albums': len(self.albums),
+            'duration': round(float(np.nansum(self.duration)), 1),
+            'filesize': int(np.nansum(self.filesize)),
+            'bitrate': self.bitrate_distribution(),
+            'samplerate': self.samplerate_distribution(),
+            'lossless_by_artist': self.lossless_share(),
+            'inconsistent_albums': self.inconsistent_albums(),
+            'missing_track_total': self.missing_track_total(),
+            'decades': self.by_decade(),
+            'genres': self.by_genre(),
+        }
+
+
+def report_save(report, filename):
+    """
+    Save a library report as text and JSON.
+
+    Args:
+        report:  A report as returned by Library.report()
+        filename:  The filename of the text report.  The JSON report is saved
+                   alongside it with a '.json' extension.
+    """
+    with open(filename, 'w') as f:
+        f.write('Tracks: ' + str(report['tracks']) + '\n')
+        f.write('Artists: ' + str(report['artists']) + '\n')
+        f.write('Albums: ' + str(report['albums']) + '\n')
+        f.write('Duration: ' + str(report['duration']) + 's\n')
+        f.write('Size: ' + str(report['filesize']) + ' bytes\n')
+        for section in ['bitrate', 'samplerate', 'genres']:
+            f.write('\n' + section.capitalize() + ':\n')
+            for key, value in report[section].items():
+                f.write('\t' + key + ': ' + str(value) + '\n')
+        f.write('\nDecades:\n')
+        for decade, totals in report['decades'].items():
+            f.write('\t' + decade + ': ' + str(totals['tracks']) + ' tracks, '
+                    + str(totals['duration']) + 's, '
+                    + str(totals['filesize']) + ' bytes\n')
+        f.write('\nLossless share by artist:\n')
+        for artist, share in report['lossless_by_artist'].items():
+            f.write('\t' + artist + ': ' + str(share['lossless']) + ' of '
+                    + str(share['tracks']) + ' tracks\n')
+        for section in ['inconsistent_albums', 'missing_track_total']:
+            f.write('\n' + section.replace('_', ' ').capitalize() + ':\n')
+            for aa in report[section]:
+                f.write('\t' + aa['artist'] + ' :: ' + aa['album'] + '\n')
+
+    name = filename
+    if name.endswith('.txt'):
+        name = name[:-4]
+    with open(name + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,102 @@
+"""Tests for release year parsing."""
+
+import random
+import logging
+import itertools
+import unittest
+from datetime import datetime
+import dates
+
+
+def _strptime_year(datestring):
+    """Parse a year with the strptime cascade parse_year() replaced."""
+    for fmt in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d', '%Y-%m', '%Y', '%y']:
+        try:
+            return datetime.strptime(datestring, fmt).year
+        except ValueError:
+            pass
+    return None
+
+
+def _date_strings(count, seed=0):
+    """Make date-like strings mixing valid and invalid parts."""
+    rand = random.Random(seed)
+    years = ['1999', '2024', '0001', '0000', '9999', '99', '68', '69', '7',
+             '12345', ' 1999', '1999 ', '+199', '-199', '19a9', '']
+    months = ['1', '01', '9', '09', '10', '12', '13', '0', '00', ' 1', '1 ',
+              '001', 'a', '']
+    days = ['1', '01', '9', '28', '29', '30', '31', '32', '0', ' 1', ' 10',
+            '1 ', '001', '']
+    parts = ['0', '00', '9', '09', '23', '24', '59', '60', '61', '62', ' 1',
+             '']
+    seps = ['-', '-', '-', '/', ' ', '', '--']
+    for _ in range(count):
+        text = rand.choice(years)
+        if rand.random() < 0.8:
+            text += rand.choice(seps) + rand.choice(months)
+            if rand.random() < 0.8:
+                text += rand.choice(seps) + rand.choice(days)
+                if rand.random() < 0.6:
+                    text += (rand.choice(['T', 't', ' ', ''])
+                             + rand.choice(parts) + rand.choice([':', ''])
+                             + rand.choice(parts) + rand.choice([':', ''])
+                             + rand.choice(parts)
+                             + rand.choice(['Z', 'z', '', 'ZZ', '+00']))
+        yield text
+
+
+class TestParseYear(unittest.TestCase):
+    """Test parse_year() against the strptime cascade it replaced."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_formats(self):
+        self.assertEqual(dates.parse_year('1979-06-01T12:30:00Z'), 1979)
+        self.assertEqual(dates.parse_year('1979-06-01'), 1979)
+        self.assertEqual(dates.parse_year('1979-06'), 1979)
+        self.assertEqual(dates.parse_year('1979'), 1979)
+        self.assertEqual(dates.parse_year('79'), 1979)
+        self.assertEqual(dates.parse_year('05'), 2005)
+        self.assertIsNone(dates.parse_year('1979-02-30'))
+        self.assertIsNone(dates.parse_year('June 1979'))
+        self.assertIsNone(dates.parse_year(''))
+
+    def test_short_strings_match_strptime(self):
+        for length in range(1, 5):
+            for chars in itertools.product('019-T: Z', repeat=length):
+                text = ''.join(chars)
+                self.assertEqual(dates.parse_year(text), _strptime_year(text),
+                                 text)
+
+    def test_generated_dates_match_strptime(self):
+        for text in _date_strings(50000):
+            self.assertEqual(dates.parse_year(text), _strptime_year(text),
+                             text)
+
+
+class TestYearResolver(unittest.TestCase):
+    """Test the memoised year resolver."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_resolves_album(self):
+        resolver = dates.YearResolver()
+        songs = [{'release_date': '1979-06-01'},
+                 {'release_date': datetime(1980, 1, 1)},
+                 {'release_date': None},
+                 {'release_date': '1979-06-01'}]
+        self.assertEqual(resolver.resolve_album(songs),
+                         [1979, 1980, None, 1979])
+        self.assertEqual(resolver.cache_info().misses, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""Tests for the external merge sort."""
+
+import random
+import tracemalloc
+import unittest
+import extsort
+
+
+def _records(count):
+    """Make records shaped like those sorted by compare_external()."""
+    for i in range(count):
+        yield ('artist ' + str(i % 5000), 'album ' + str(i), i % 2, i,
+               'Artist ' + str(i % 5000), 'Album ' + str(i))
+
+
+class TestExternalSorter(unittest.TestCase):
+    """Test sorting with and without spilling to disk."""
+
+    def test_sorts_in_memory(self):
+        records = list(range(1000))
+        random.shuffle(records)
+        sorter = extsort.ExternalSorter().extend(records)
+        self.assertEqual(sorter.runs, 0)
+        self.assertEqual(sorter.count, 1000)
+        self.assertEqual(list(sorter), sorted(records))
+
+    def test_spills_at_memory_limit(self):
+        limit = 1024 * 1024
+        sorter = extsort.ExternalSorter(key=lambda r: (r[0], r[1]),
+                                        memory_limit=limit)
+        tracemalloc.start()
+        try:
+            sorter.extend(_records(50000))
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertGreater(sorter.runs, 1)
+        self.assertEqual(sorter.count, 50000)
+        self.assertLess(peak, 2 * limit)
+        self.assertEqual(list(sorter),
+                         sorted(_records(50000), key=lambda r: (r[0], r[1])))
+
+    def test_sizeof_counts_contents(self):
+        record = ('a' * 1000, {'title': 'b' * 1000})
+        self.assertGreater(extsort.sizeof(record), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
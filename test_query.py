@@ -0,0 +1,204 @@
+"""Tests for querying an index with filter expressions."""
+
+import random
+import logging
+import unittest
+import query
+
+
+def _track(title, bitrate=None, year=None, **tags):
+    """Make the tag dictionary for a track."""
+    track_tags = {'title': title, 'bitrate': bitrate, 'release_date': year,
+                  'genre': 'Rock', 'location': '/music/' + title + '.mp3'}
+    track_tags.update(tags)
+    return track_tags
+
+
+def _library():
+    """Make a small index covering numeric, text and missing values."""
+    return {
+        'AC/DC': {
+            'Back in Black': [
+                _track('Hells Bells', 128, '1980', track='1/10', disc=1),
+                _track('Shoot to Thrill', 320, '1980-07-25', track=2,
+                       disc=1, disc_total=2),
+            ],
+        },
+        'Blondie': {
+            'Parallel Lines': [
+                _track('4/4', 96, '1978', genre='rock', track=4),
+                _track('Untagged'),
+            ],
+        },
+        'nan': {
+            'INF': [
+                _track('Sunrise', 1411, '79', genre='INF', track='3'),
+            ],
+        },
+    }
+
+
+def _random_library(seed):
+    """Make a larger index with values drawn at random."""
+    rand = random.Random(seed)
+    music = {}
+    for i in range(2000):
+        artist = rand.choice(['A', 'b', 'B', 'C', 'nan'])
+        album = rand.choice(['X', 'Y', '1999'])
+        music.setdefault(artist, {}).setdefault(album, []).append(_track(
+            'T' + str(i),
+            rand.choice([None, 96, 128, 192, 256, 320, '320', 'n/a']),
+            rand.choice([None, '1969', '1975-01-01', '1980-02', '99', 'bad']),
+            genre=rand.choice([None, 'Rock', 'rock', 'Jazz', 'NaN']),
+            duration=rand.choice([None, 180.5, 240, 'nan']),
+            track=rand.choice([None, 1, '2', '3/12', ''])))
+    return music
+
+
+def _titles(results):
+    """Get the titles of the tracks found by a query."""
+    return [track_tags['title'] for artist, album, track_tags in results]
+
+
+class TestParse(unittest.TestCase):
+    """Test splitting and parsing filter expressions."""
+
+    def test_tokenise(self):
+        self.assertEqual(
+            query.tokenise('genre == "Hard Rock" AND bitrate>=192.5 or not '
+                           "(album != 'x')"),
+            [('field', 'genre'), ('op', '=='), ('value', 'Hard Rock'),
+             ('keyword', 'and'), ('field', 'bitrate'), ('op', '>='),
+             ('value', '192.5'), ('keyword', 'or'), ('keyword', 'not'),
+             ('bracket', '('), ('field', 'album'), ('op', '!='),
+             ('value', 'x'), ('bracket', ')')])
+
+    def test_tokenise_rejects_unknown_text(self):
+        with self.assertRaises(ValueError):
+            query.tokenise('genre ~ "rock"')
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertEqual(
+            query.parse('a == 1 or b == 2 and not c == 3'),
+            ('or',
+             ('cmp', '==', ('field', 'a'), ('value', '1')),
+             ('and',
+              ('cmp', '==', ('field', 'b'), ('value', '2')),
+              ('not', ('cmp', '==', ('field', 'c'), ('value', '3'))))))
+
+    def test_brackets(self):
+        self.assertEqual(
+            query.parse('(a == 1 or b == 2) and c == 3'),
+            ('and',
+             ('or',
+              ('cmp', '==', ('field', 'a'), ('value', '1')),
+              ('cmp', '==', ('field', 'b'), ('value', '2'))),
+             ('cmp', '==', ('field', 'c'), ('value', '3'))))
+
+    def test_invalid_expressions(self):
+        for expression in ['genre ==', '== "rock"', 'genre "rock"',
+                           '(genre == "rock"', 'genre == "rock")',
+                           'genre == "rock" bitrate < 192', 'and', '']:
+            with self.assertRaises(ValueError, msg=expression):
+                query.parse(expression)
+
+
+class TestQueryIndex(unittest.TestCase):
+    """Test queries against the secondary indexes and full scans."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.index = query.QueryIndex(_library())
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_numeric_fields(self):
+        self.assertEqual(_titles(self.index.query('bitrate < 192')),
+                         ['Hells Bells', '4/4'])
+        self.assertEqual(_titles(self.index.query('track == 1')),
+                         ['Hells Bells'])
+        self.assertEqual(_titles(self.index.query('decade == 1970')),
+                         ['4/4', 'Sunrise'])
+
+    def test_text_fields(self):
+        self.assertEqual(_titles(self.index.query('genre == "ROCK"')),
+                         ['Hells Bells', 'Shoot to Thrill', '4/4',
+                          'Untagged'])
+        self.assertEqual(_titles(self.index.query('title == 4')), [])
+        self.assertEqual(_titles(self.index.query('title == "4/4"')),
+                         ['4/4'])
+        self.assertEqual(_titles(self.index.query('artist == "NaN"')),
+                         ['Sunrise'])
+        self.assertEqual(_titles(self.index.query('genre == "inf"')),
+                         ['Sunrise'])
+
+    def test_operands_are_flipped(self):
+        for flipped, expression in [('192 > bitrate', 'bitrate < 192'),
+                                    ('192 <= bitrate', 'bitrate >= 192'),
+                                    ('1980 == year', 'year == 1980'),
+                                    ('"rock" == genre', 'genre == "rock"')]:
+            self.assertIsNotNone(
+                self.index._candidates(query.parse(flipped)), flipped)
+            self.assertEqual(self.index.query(flipped),
+                             self.index.query(expression), flipped)
+
+    def test_or_and_not_fall_back_to_full_scan(self):
+        for expression in ['not bitrate < 192',
+                           'bitrate < 192 or disc < disc_total',
+                           'genre == "jazz" or title == "Untagged"']:
+            self.assertIsNone(
+                self.index._candidates(query.parse(expression)), expression)
+        self.assertEqual(_titles(self.index.query('not bitrate < 192')),
+                         ['Shoot to Thrill', 'Untagged', 'Sunrise'])
+        self.assertEqual(
+            _titles(self.index.query('bitrate < 100 or disc < disc_total')),
+            ['Shoot to Thrill', '4/4'])
+
+    def test_missing_values_never_match(self):
+        self.assertNotIn('Untagged',
+                         _titles(self.index.query('bitrate < 9999')))
+        self.assertNotIn('Untagged', _titles(self.index.query('bitrate >= 0')))
+        self.assertNotIn('Untagged',
+                         _titles(self.index.query('bitrate != 128')))
+        self.assertNotIn('Untagged', _titles(self.index.query('year > 0')))
+        self.assertEqual(_titles(self.index.query('disc < disc_total')),
+                         ['Shoot to Thrill'])
+        self.assertEqual(self.index.query('bitrate == "n/a"'), [])
+
+    def test_indexes_match_full_scan(self):
+        index = query.QueryIndex(_random_library(0))
+        rand = random.Random(1)
+        fields = ['artist', 'album', 'genre', 'year', 'decade', 'bitrate',
+                  'duration', 'track', 'title']
+        values = ['"a"', '"B"', '"nan"', '"rock"', '"1999"', '1969', '1975',
+                  '1970', '99', '128', '192', '320', '180.5', '2', '"3/12"',
+                  '"n/a"']
+        ops = list(query.OPERATORS)
+
+        def comparison():
+            field, value = rand.choice(fields), rand.choice(values)
+            if rand.random() < 0.3:
+                return value + ' ' + rand.choice(ops) + ' ' + field
+            return field + ' ' + rand.choice(ops) + ' ' + value
+
+        def expression(depth=0):
+            if depth > 2 or rand.random() < 0.4:
+                return comparison()
+            choice = rand.random()
+            if choice < 0.45:
+                return expression(depth + 1) + ' and ' + expression(depth + 1)
+            if choice < 0.8:
+                return expression(depth + 1) + ' or ' + expression(depth + 1)
+            return 'not (' + expression(depth + 1) + ')'
+
+        for _ in range(500):
+            text = expression()
+            tree = query.parse(text)
+            scanned = [index._tracks[row] for row in range(len(index))
+                       if index._match(tree, row)]
+            self.assertEqual(index.query(text), scanned, text)
+
+
+if __name__ == '__main__':
+    unittest.main()